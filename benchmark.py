@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import itertools
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from datasets_metadata import ts_metadata
+from preprocessing_utilities import FLOAT32_TOLERANCE
+from shaping_methods import METHODS, get_method, methods_with, process_windows, process_block, block_options
+from raw_loader import load_dataset
+
+PROCESS_FNS = {name: method["process_fn"] for name, method in METHODS.items()}
+DTW_PARAMS = {} # NOTE: same settings as the drivers
+SYNTHETIC = "synthetic"
+STRIDE_CHECK_DATASETS = ["ETTm1", "ETTm2", "Weather"] # NOTE: the long series the stride is meant for
+
+# NOTE: the full grid takes a while, --quick keeps one point per axis end
+GRID = {
+    "methods": list(PROCESS_FNS),
+    "sizes": [2000, 8000, 32000],
+    "datasets": ["ETTh1", "ETTm1", "Weather"],
+    "windows": ts_metadata["ETTh1"]["farm_windows"],
+    "features": [1, 4, 16],
+}
+QUICK_GRID = {
+    "methods": list(PROCESS_FNS),
+    "sizes": [4000],
+    "datasets": ["ETTh1"],
+    "windows": [501, 1501],
+    "features": [1, 6],
+}
+
+
+def synthetic_frame(n_rows, n_features, seed=0):
+    '''
+    Target "y" and n_features exogenous random walks, correlated with the target to a varying degree
+    '''
+    rng = np.random.default_rng(seed)
+    target = np.cumsum(rng.standard_normal(n_rows))
+    columns = {"y": target}
+    for i in range(n_features):
+        weight = (i + 1) / (n_features + 1)
+        columns[f"x{i}"] = weight * target + (1 - weight) * np.cumsum(rng.standard_normal(n_rows))
+    return pd.DataFrame(columns)
+
+def _case_frame(case):
+    if case["source"] == SYNTHETIC:
+        df_raw = synthetic_frame(case["n_rows"], case["n_features"])
+        return df_raw, "y", [column for column in df_raw.columns if column != "y"]
+    df_raw = load_dataset(case["source"])
+    target_ts = str(ts_metadata[case["source"]]["target_ts"])
+    exog_list = [str(feature) for feature in ts_metadata[case["source"]]["exog_list"] if str(feature) != target_ts]
+    return df_raw, target_ts, exog_list[:case["n_features"]]
+
+def _shape(process_fn, df_raw, target_feature, exogenous_features, window, dtype="float64", stride=None, interpolation="linear"):
+    # NOTE: the same path the drivers take, vectorized over the features when the method allows it
+    # stride=None keeps each method's default (DTW_PARAMS for pdtw), 1 is exact
+    stride_params = {} if stride is None else {"stride": stride, "stride_interpolation": interpolation}
+    params = {
+        "df_raw": df_raw,
+        "windows": [window],
+        "target_feature": target_feature,
+        "dtype": dtype,
+        **DTW_PARAMS,
+        **stride_params
+    }
+    if get_method(process_fn)["batch_columns"]:
+        return process_block(process_fn, df_raw, target_feature, exogenous_features, [window], **block_options(process_fn, params))
+    return [process_windows(process_fn, dict(params, exogenous_feature=feature)) for feature in exogenous_features]
+
+def run_case(case, repeat):
+    '''
+    Runs one (method, source, n_rows, n_features, window) case repeat times in this process and
+    returns its best wall time, the peak RSS of the process before and after shaping and the
+    throughput in rows*features/s
+    '''
+    process_fn = PROCESS_FNS[case["method"]]
+    df_raw, target_feature, exogenous_features = _case_frame(case)
+    rss_before_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # NOTE: KiB on Linux, imports and data included
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _shape(process_fn, df_raw, target_feature, exogenous_features, case["window"])
+        timings += [time.perf_counter() - start]
+    seconds = min(timings)
+    n_rows, n_features = len(df_raw), len(exogenous_features)
+    return dict(
+        case,
+        n_rows=n_rows,
+        n_features=n_features,
+        seconds=seconds,
+        seconds_all=timings,
+        rss_before_mb=rss_before_mb,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        throughput=n_rows * n_features / seconds if seconds > 0 else float("inf"),
+    )
+
+def cases(grid):
+    for method, size, window, n_features in itertools.product(grid["methods"], grid["sizes"], grid["windows"], grid["features"]):
+        if window < size:
+            yield {"method": method, "source": SYNTHETIC, "n_rows": size, "n_features": n_features, "window": window}
+    for method, dataset_name, window, n_features in itertools.product(grid["methods"], grid["datasets"], grid["windows"], grid["features"]):
+        yield {"method": method, "source": dataset_name, "n_rows": None, "n_features": n_features, "window": window}
+
+def case_key(result):
+    return f'{result["method"]}|{result["source"]}|{result["n_rows"]}|{result["n_features"]}|{result["window"]}'
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "cpu_count": os.cpu_count(),
+        "commit": commit,
+    }
+
+def run_benchmarks(grid, repeat=3):
+    '''
+    Runs every case in a fresh worker process, so the peak RSS belongs to that case alone
+    '''
+    results = []
+    context = multiprocessing.get_context("forkserver")
+    for case in cases(grid):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case, repeat).result()
+        print(f'{case_key(result):<50} {result["seconds"]:9.4f}s {result["peak_rss_mb"]:9.1f} MiB {result["throughput"]:14.0f} rows*features/s', flush=True)
+        results += [result]
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Cases slower (or with a higher peak RSS) than the baseline by more than tolerance, as
+    [(key, metric, baseline value, value)]. Cases missing from the baseline are not compared.
+    '''
+    baseline = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline.get(case_key(result))
+        if reference is None:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions += [(case_key(result), metric, reference[metric], result[metric])]
+    return regressions
+
+def _deviations(reference, results, window):
+    # NOTE: |result - reference| of every shaped column over the max |value| of the reference column
+    deviations = []
+    for (expected_windows, _), (actual_windows, _) in zip(reference, results):
+        for key in ("shaped", "inverted_shaped"):
+            expected = expected_windows[window][key].to_numpy(dtype=np.float64)
+            actual = actual_windows[window][key].to_numpy(dtype=np.float64)
+            scale = max(np.nanmax(np.abs(expected), initial=0), np.finfo(np.float64).tiny)
+            deviations += [np.abs(actual - expected) / scale]
+    return np.concatenate(deviations)
+
+def precision_check(methods, n_rows=4000, n_features=4, window=501):
+    '''
+    Largest deviation of the float32 shaped series from the float64 ones per method, relative to the
+    max |value| of the shaped column, as {method: (deviation, within FLOAT32_TOLERANCE)}
+    '''
+    df_raw = synthetic_frame(n_rows, n_features)
+    exogenous_features = [column for column in df_raw.columns if column != "y"]
+    deviations = {}
+    for method in methods:
+        shaped = {
+            dtype: _shape(PROCESS_FNS[method], df_raw, "y", exogenous_features, window, dtype=dtype)
+            for dtype in ("float64", "float32")
+        }
+        deviation = np.nanmax(_deviations(shaped["float64"], shaped["float32"], window), initial=0)
+        deviations[method] = (deviation, deviation <= FLOAT32_TOLERANCE)
+    return deviations
+
+def stride_check(methods, datasets, windows, strides, interpolations=("linear",), n_features=1):
+    '''
+    Error report of the strided saliency: for every method, dataset, window, stride and interpolation,
+    the max and mean deviation of the strided shaped series from the exact (stride 1) ones, relative to
+    the max |value| of the shaped column, with the exact and strided wall times and the speedup.
+    '''
+    rows = []
+    for method, dataset_name, window in itertools.product(methods, datasets, windows):
+        df_raw, target_feature, exogenous_features = _case_frame({"source": dataset_name, "n_features": n_features})
+        process_fn = PROCESS_FNS[method]
+        start = time.perf_counter()
+        exact = _shape(process_fn, df_raw, target_feature, exogenous_features, window, stride=1)
+        exact_seconds = time.perf_counter() - start
+        for stride, interpolation in itertools.product(strides, interpolations):
+            start = time.perf_counter()
+            strided = _shape(process_fn, df_raw, target_feature, exogenous_features, window, stride=stride, interpolation=interpolation)
+            seconds = time.perf_counter() - start
+            deviations = _deviations(exact, strided, window)
+            row = {
+                "method": method,
+                "source": dataset_name,
+                "window": window,
+                "stride": stride,
+                "interpolation": interpolation,
+                "max_deviation": float(np.nanmax(deviations, initial=0)),
+                "mean_deviation": float(np.nanmean(deviations)) if deviations.size else 0.0,
+                "exact_seconds": exact_seconds,
+                "seconds": seconds,
+                "speedup": exact_seconds / seconds if seconds > 0 else float("inf"),
+            }
+            print(f'{method}|{dataset_name}|{window} stride {stride} {interpolation:<6} max {row["max_deviation"]:.2e} mean {row["mean_deviation"]:.2e} {exact_seconds:8.3f}s -> {seconds:8.3f}s x{row["speedup"]:.1f}', flush=True)
+            rows += [row]
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the shaping methods across data sizes, windows and exogenous columns")
+    parser.add_argument("--quick", action="store_true", help="small grid for a smoke run")
+    parser.add_argument("--methods", nargs="+", choices=list(PROCESS_FNS))
+    parser.add_argument("--sizes", nargs="*", type=int, help="synthetic series lengths, none to skip synthetic data")
+    parser.add_argument("--datasets", nargs="*", choices=list(ts_metadata), help="bundled datasets, none to skip them")
+    parser.add_argument("--windows", nargs="+", type=int)
+    parser.add_argument("--features", nargs="+", type=int, help="numbers of exogenous columns")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best one is reported")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown flagged as a regression")
+    parser.add_argument("--precision-check", action="store_true", help="only compare the float32 shaped series with the float64 ones")
+    parser.add_argument("--stride-check", nargs="+", type=int, metavar="STRIDE", help="only report the error and speedup of these saliency strides against exact")
+    parser.add_argument("--interpolations", nargs="+", choices=["linear", "step"], default=["linear"], help="interpolations of the stride check")
+    args = parser.parse_args(argv)
+
+    if args.precision_check:
+        deviations = precision_check(args.methods or list(PROCESS_FNS))
+        for method, (deviation, ok) in deviations.items():
+            print(f"{method:<15} max relative deviation {deviation:.2e} {'ok' if ok else f'ABOVE {FLOAT32_TOLERANCE:.0e}'}")
+        return 0 if all(ok for _, ok in deviations.values()) else 1
+
+    if args.stride_check:
+        methods = [method for method in args.methods or list(PROCESS_FNS) if method in methods_with(strided=True)]
+        rows = stride_check(
+            methods,
+            args.datasets or STRIDE_CHECK_DATASETS,
+            args.windows or [1501],
+            args.stride_check,
+            args.interpolations,
+            n_features=(args.features or [1])[0]
+        )
+        with open(args.output, "w") as file:
+            json.dump({"machine": machine_info(), "stride_check": rows}, file, indent=1)
+        print(f"Saved to: {args.output}")
+        return 0
+
+    grid = dict(QUICK_GRID if args.quick else GRID)
+    for axis in grid:
+        if getattr(args, axis) is not None:
+            grid[axis] = getattr(args, axis)
+
+    results = run_benchmarks(grid, repeat=args.repeat)
+    with open(args.output, "w") as file:
+        json.dump({"machine": machine_info(), "grid": grid, "repeat": args.repeat, "results": results}, file, indent=1)
+    print(f"Saved to: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for key, metric, reference, value in regressions:
+            print(f"REGRESSION {key} {metric}: {reference:.4f} -> {value:.4f} ({value / reference - 1:+.0%})")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
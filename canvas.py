@@ -1,35 +1,177 @@
 import os
-import pandas as pd
-
-def convert_csv_to_parquet(root_dir='.'):
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.csv'):
-                csv_path = os.path.join(subdir, file)
-                try:
-                    print(f"Processing: {csv_path}")
-                    df = pd.read_csv(csv_path)
-                    
-                    parquet_path = os.path.splitext(csv_path)[0] + '.parquet'
-                    df.to_parquet(parquet_path, compression='snappy')
-                    print(f"Saved to: {parquet_path}")
-                except Exception as e:
-                    print(f"Failed to process {csv_path}: {e}")
-
-def convert_parquet_to_csv(root_dir='.'):
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.parquet'):
-                parquet_path = os.path.join(subdir, file)
-                try:
-                    print(f"Processing: {parquet_path}")
-                    df = pd.read_parquet(parquet_path)
-                    
-                    parquet_path = os.path.splitext(parquet_path)[0] + '.csv'
-                    df.to_csv(parquet_path, index=False)
-                    print(f"Saved to: {parquet_path}")
-                except Exception as e:
-                    print(f"Failed to process {parquet_path}: {e}")
+import json
+import hashlib
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed
+
+MANIFEST = ".conversion_manifest.json"
+CSV_BLOCK_SIZE = 64 * 1024**2 # NOTE: bytes of CSV parsed per batch, bounds the memory of a conversion
+ROW_GROUP_SIZE = 65536
+
+
+def _file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024**2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _load_manifest(root_dir):
+    try:
+        with open(os.path.join(root_dir, MANIFEST)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_manifest(root_dir, manifest):
+    path = os.path.join(root_dir, MANIFEST)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def _is_up_to_date(source, target, entry):
+    '''
+    Skips a file when its target exists and the source is unchanged since the last conversion
+    (same size and mtime, or same content hash if only the mtime moved). Files converted before
+    the manifest existed are skipped when the target is newer than the source.
+    '''
+    if not os.path.exists(target):
+        return False
+    if entry is None:
+        return os.path.getmtime(target) >= os.path.getmtime(source)
+    if entry["stamp"] == _source_stamp(source):
+        return True
+    return entry["stamp"]["size"] == os.path.getsize(source) and entry["hash"] == _file_hash(source)
+
+def _walk(root_dir, extension):
+    for subdir, dirs, files in os.walk(root_dir):
+        dirs[:] = [directory for directory in dirs if not directory.startswith(".")] # NOTE: skip caches such as raw/.cache
+        for file in sorted(files):
+            if file.endswith(extension):
+                yield os.path.join(subdir, file)
+
+def _downcast(batch, float32, dictionary):
+    columns = []
+    for column in batch.columns:
+        if float32 and pa.types.is_float64(column.type):
+            column = column.cast(pa.float32())
+        elif dictionary and (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+            column = column.dictionary_encode()
+        columns += [column]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+def _convert_options(csv_path, block_size):
+    # NOTE: dates stay strings, as pd.read_csv leaves them
+    schema = pacsv.open_csv(csv_path, read_options=pacsv.ReadOptions(block_size=block_size)).schema
+    return pacsv.ConvertOptions(column_types={
+        field.name: pa.string() for field in schema if pa.types.is_temporal(field.type)
+    })
+
+def _stream_csv_to_parquet(csv_path, tmp_path, float32, dictionary, block_size, row_group_size):
+    # NOTE: streamed block by block, only one block of the CSV is in memory at a time
+    reader = pacsv.open_csv(csv_path, read_options=pacsv.ReadOptions(block_size=block_size), convert_options=_convert_options(csv_path, block_size))
+    writer = None
+    try:
+        for batch in reader:
+            batch = _downcast(batch, float32, dictionary)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, batch.schema, compression="snappy")
+            writer.write_batch(batch, row_group_size=row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError("empty file")
+
+def _csv_to_parquet(csv_path, parquet_path, float32, dictionary, block_size, row_group_size):
+    tmp_path = f"{parquet_path}.tmp"
+    try:
+        try:
+            _stream_csv_to_parquet(csv_path, tmp_path, float32, dictionary, block_size, row_group_size)
+        except pa.ArrowInvalid:
+            # NOTE: types inferred from the first block did not fit a later one, read the whole file instead
+            table = pacsv.read_csv(csv_path, convert_options=_convert_options(csv_path, block_size))
+            batches = [_downcast(batch, float32, dictionary) for batch in table.to_batches()]
+            pq.write_table(pa.Table.from_batches(batches), tmp_path, compression="snappy", row_group_size=row_group_size)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return str(e)
+    os.replace(tmp_path, parquet_path)
+    return None
+
+def _parquet_to_csv(parquet_path, csv_path, row_group_size):
+    tmp_path = f"{csv_path}.tmp"
+    try:
+        parquet_file = pq.ParquetFile(parquet_path)
+        with open(tmp_path, "w", newline="") as file:
+            header = True
+            for batch in parquet_file.iter_batches(batch_size=row_group_size):
+                # NOTE: each batch goes through pandas as read_parquet would, so number formats, quoting and the dropped index are to_csv's
+                pa.Table.from_batches([batch]).to_pandas().to_csv(file, index=False, header=header)
+                header = False
+            if header:
+                parquet_file.schema_arrow.empty_table().to_pandas().to_csv(file, index=False)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return str(e)
+    os.replace(tmp_path, csv_path)
+    return None
+
+def _convert_file(convert, source, target):
+    # NOTE: the manifest entry is taken in the worker, hashing large files is not free
+    entry = {"stamp": _source_stamp(source), "hash": _file_hash(source)}
+    return source, target, convert(source, target), entry
+
+def _convert_tree(root_dir, extension, target_extension, convert, n_jobs, force):
+    manifest = _load_manifest(root_dir)
+    direction = f"{extension}->{target_extension}"
+    entries = manifest.setdefault(direction, {})
+
+    pending = []
+    for source in _walk(root_dir, extension):
+        target = os.path.splitext(source)[0] + target_extension
+        key = os.path.relpath(source, root_dir)
+        if not force and _is_up_to_date(source, target, entries.get(key)):
+            continue
+        pending += [(source, target)]
+    print(f"Converting {len(pending)} files, skipping the up to date ones")
+
+    for source, target, error, entry in Parallel(n_jobs=n_jobs, return_as="generator_unordered")(delayed(_convert_file)(convert, source, target) for source, target in pending):
+        if error is not None:
+            print(f"Failed to process {source}: {error}")
+            continue
+        print(f"Saved to: {target}")
+        entries[os.path.relpath(source, root_dir)] = entry
+        _save_manifest(root_dir, manifest) # NOTE: saved per file so an interrupted run resumes where it stopped
+
+def convert_csv_to_parquet(root_dir='.', n_jobs=-1, float32=False, dictionary=False, block_size=CSV_BLOCK_SIZE, row_group_size=ROW_GROUP_SIZE, force=False):
+    '''
+    Converts every CSV under root_dir to a Parquet file next to it, in a process pool.
+    Files whose Parquet is up to date (see _is_up_to_date, tracked in root_dir/.conversion_manifest.json)
+    are skipped unless force. Large CSVs are streamed in blocks of block_size bytes into row groups,
+    so memory stays bounded. float32 downcasts float64 columns, dictionary stores string columns
+    dictionary-encoded (read back as pandas categoricals).
+    '''
+    convert = lambda source, target: _csv_to_parquet(source, target, float32, dictionary, block_size, row_group_size)
+    _convert_tree(root_dir, ".csv", ".parquet", convert, n_jobs, force)
+
+def convert_parquet_to_csv(root_dir='.', n_jobs=-1, row_group_size=ROW_GROUP_SIZE, force=False):
+    '''
+    Converts every Parquet file under root_dir to a CSV next to it, batch by batch, in a process pool.
+    The CSV holds what pd.read_parquet(path).to_csv(index=False) writes.
+    Up to date CSVs are skipped unless force, as in convert_csv_to_parquet.
+    '''
+    convert = lambda source, target: _parquet_to_csv(source, target, row_group_size)
+    _convert_tree(root_dir, ".parquet", ".csv", convert, n_jobs, force)
 
 # Run the conversion in the current directory
 if __name__ == '__main__':
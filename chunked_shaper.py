@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pyinform.utils.coalesce import coalesce_series
+
+from preprocessing_utilities import multi_window_corr, multi_window_cov, multi_window_relative_entropy, multi_window_mutual_info
+from preprocessing_utilities import rolling_dtw, rolling_lb_keogh, saliency_stride, shape_saliency, shaped_dtype
+from telemetry import span
+
+CHUNK_BYTES = 256 * 1024**2 # NOTE: working set of one batch, read values plus saliency and shaped blocks of every window
+COLUMN_GROUP = 64 # NOTE: exogenous columns read together in the saliency pass
+
+
+def _batch_rows(chunk_bytes, n_columns, windows):
+    # NOTE: about one float64 value, and a saliency, shaped and inverted value per window, for every cell of a batch
+    return max(chunk_bytes // (8 * n_columns * (1 + 3 * len(windows))), 4 * max(windows))
+
+def _batch_values(batch, columns):
+    return np.column_stack([batch.column(column).to_numpy(zero_copy_only=False).astype(np.float64, copy=False) for column in columns])
+
+def _pad_rows(saliency, window, n):
+    # NOTE: sliding window results start at the first full window
+    padded = np.full(n, np.nan)
+    padded[window - 1:] = saliency
+    return padded
+
+def _corr_chunk(target, block, windows, params, labels):
+    return multi_window_corr(target, block, windows)
+
+def _cov_chunk(target, block, windows, params, labels):
+    return multi_window_cov(target, block, windows)
+
+def _entropy_chunk(target, block, windows, params, labels):
+    # NOTE: the states are labelled over the whole column (as coalesce_series does), relative entropy depends on the labels
+    target_states = np.searchsorted(labels[0], target.astype(np.int32))
+    saliencies = {window: np.empty(block.shape) for window in windows}
+    for column in range(block.shape[1]):
+        exogenous_states = np.searchsorted(labels[1][column], block[:, column].astype(np.int32))
+        for window, saliency in multi_window_relative_entropy(target_states, exogenous_states, windows).items():
+            saliencies[window][:, column] = _pad_rows(saliency, window, block.shape[0])
+    return saliencies
+
+def _mutual_info_chunk(target, block, windows, params, labels):
+    # NOTE: mutual information does not depend on the labels, coalescing the chunk alone is enough
+    target_states, _ = coalesce_series(target)
+    saliencies = {window: np.empty(block.shape) for window in windows}
+    for column in range(block.shape[1]):
+        exogenous_states, _ = coalesce_series(block[:, column])
+        for window, saliency in multi_window_mutual_info(target_states, exogenous_states, windows).items():
+            saliencies[window][:, column] = _pad_rows(saliency, window, block.shape[0])
+    return saliencies
+
+def _dtw_chunk(target, block, windows, params, labels):
+    saliencies = {window: np.full(block.shape, np.nan) for window in windows}
+    for window in windows:
+        if params.get("dtw_lower_bound", False):
+            for column in range(block.shape[1]):
+                saliencies[window][window - 1:, column] = rolling_lb_keogh(target, block[:, column], window, band=params.get("dtw_band"))
+        else:
+            # NOTE: all columns at once, see rolling_dtw
+            saliencies[window][window - 1:] = rolling_dtw(
+                target,
+                block,
+                window,
+                band=params.get("dtw_band"),
+                stride=params.get("stride", params.get("dtw_stride", 1)),
+                n_jobs=params.get("n_jobs", 1),
+                interpolation=saliency_stride(params)[1]
+            )
+    return saliencies
+
+CHUNKED_SALIENCY = {
+    "prollcorr": _corr_chunk,
+    "prollcov": _cov_chunk,
+    "pentropy": _entropy_chunk,
+    "pmutual_info": _mutual_info_chunk,
+    "pdtw": _dtw_chunk,
+}
+
+def _chunk_saliency(method, target, block, windows, params, labels):
+    fitting = [window for window in windows if window <= target.size]
+    saliencies = CHUNKED_SALIENCY[method](target, block, fitting, params, labels) if fitting else {}
+    return {window: saliencies.get(window, np.full(block.shape, np.nan)) for window in windows}
+
+def _state_labels(parquet_file, columns, rows):
+    '''
+    Sorted integer states of every column, the labels coalesce_series would give over the whole column.
+    Only the distinct states are kept, never the values.
+    '''
+    labels = {column: np.empty(0, dtype=np.int32) for column in columns}
+    for batch in parquet_file.iter_batches(batch_size=rows, columns=columns):
+        values = _batch_values(batch, columns)
+        for i, column in enumerate(columns):
+            labels[column] = np.union1d(labels[column], values[:, i].astype(np.int32))
+    return labels
+
+def _saliency_pass(parquet_file, method, windows, target_feature, exogenous_features, params, saliency_paths, rows, column_group):
+    '''
+    First pass: reads the target and one group of exogenous columns at a time, batch by batch, computing the
+    saliency of each batch with the window-1 last rows of the previous one in front. Saliencies go to the (n, k) saliency_paths files and their
+    per-column min/max are reduced on the way, so normalization never reads the raw data again.
+    Returns {window: (saliency_min, saliency_max)}
+    '''
+    overlap = max(windows) - 1
+    labels = _state_labels(parquet_file, [target_feature] + exogenous_features, rows) if method == "pentropy" else None
+    ranges = {window: (np.full(len(exogenous_features), np.nan), np.full(len(exogenous_features), np.nan)) for window in windows}
+
+    for start in range(0, len(exogenous_features), column_group):
+        group = exogenous_features[start:start + column_group]
+        group_labels = (labels[target_feature], [labels[column] for column in group]) if labels else None
+        saliency_files = {window: np.load(path, mmap_mode="r+") for window, path in saliency_paths.items()}
+        tail = np.empty((0, len(group) + 1))
+        row = 0
+        with span("saliency", method=method, feature=f"columns {start}:{start + len(group)}", window=",".join(str(window) for window in windows)):
+            for batch in parquet_file.iter_batches(batch_size=rows, columns=[target_feature] + group):
+                values = np.concatenate((tail, _batch_values(batch, [target_feature] + group)))
+                saliencies = _chunk_saliency(method, values[:, 0], values[:, 1:], windows, params, group_labels)
+                for window, saliency in saliencies.items():
+                    saliency = saliency[-batch.num_rows:]
+                    saliency_files[window][row:row + batch.num_rows, start:start + len(group)] = saliency
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", RuntimeWarning) # NOTE: all-NaN chunks leave the range as it is
+                        saliency_min, saliency_max = ranges[window]
+                        np.fmin(saliency_min[start:start + len(group)], np.nanmin(saliency, axis=0), out=saliency_min[start:start + len(group)])
+                        np.fmax(saliency_max[start:start + len(group)], np.nanmax(saliency, axis=0), out=saliency_max[start:start + len(group)])
+                tail = values[max(values.shape[0] - overlap, 0):]
+                row += batch.num_rows
+        del saliency_files
+    return ranges
+
+def chunked_paths(output_path, dataset_name, method, windows):
+    return {
+        window: (
+            os.path.join(output_path, f"{dataset_name}_w{window}_{method}.parquet"),
+            os.path.join(output_path, f"{dataset_name}_w{window}_i{method}.parquet")
+        )
+        for window in windows
+    }
+
+def shape_parquet(source_path, output_path, method, windows, target_feature, exogenous_features=None, params=None, dataset_name=None, chunk_rows=None, column_group=COLUMN_GROUP, chunk_bytes=CHUNK_BYTES, work_directory=None):
+    '''
+    OUT-OF-CORE SHAPING
+    Shapes a Parquet file too large for memory with method ("prollcorr", "prollcov", "pentropy", "pmutual_info"
+    or "pdtw"), reading it batch by batch and never holding more than about chunk_bytes of it:
+    1. saliency pass (_saliency_pass): per group of column_group exogenous columns, the saliency of every batch
+       with an overlap carried from the previous one, spilled to a float64 memmap in work_directory
+       (output_path by default) while its global min/max per column is reduced;
+    2. shaping pass: every batch of all columns is shaped with that fixed min/max (shape_saliency's
+       saliency_range) and appended as a row group to {dataset_name}_w{window}_{method}.parquet and
+       {dataset_name}_w{window}_i{method}.parquet, the raw columns passing through unchanged.
+    params holds the method options of the p* functions ("dtype", "stride", "stride_interpolation", "dtw_band", ...).
+    Batches are chunk_rows long, or sized from chunk_bytes. The results match the in-memory p* functions up to
+    rounding, but with a stride the evaluated DTW windows restart on every batch. pfarm is not supported, FARM
+    is one call over the whole series, nor pnoise, its draw is one stream over the whole column.
+    Returns {window: (shaped_path, inverted_path)}
+    '''
+    if method not in CHUNKED_SALIENCY:
+        raise ValueError(f"No chunked mode for {method}, available: {list(CHUNKED_SALIENCY)}")
+    params = params or {}
+    dtype = shaped_dtype(params)
+    target_feature = str(target_feature)
+    dataset_name = dataset_name or os.path.splitext(os.path.basename(source_path))[0]
+
+    parquet_file = pq.ParquetFile(source_path)
+    schema = parquet_file.schema_arrow
+    if exogenous_features is None:
+        exogenous_features = [
+            field.name for field in schema
+            if field.name != target_feature and (pa.types.is_floating(field.type) or pa.types.is_integer(field.type))
+        ]
+    exogenous_features = [str(feature) for feature in exogenous_features]
+    n = parquet_file.metadata.num_rows
+
+    os.makedirs(output_path, exist_ok=True)
+    work_directory = tempfile.mkdtemp(prefix="chunked_", dir=work_directory or output_path)
+    try:
+        saliency_paths = {window: os.path.join(work_directory, f"saliency_w{window}.npy") for window in windows}
+        for window, path in saliency_paths.items():
+            np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(n, len(exogenous_features)))
+        rows = chunk_rows or _batch_rows(chunk_bytes, len(exogenous_features[:column_group]) + 1, windows)
+        ranges = _saliency_pass(parquet_file, method, windows, target_feature, exogenous_features, params, saliency_paths, rows, column_group)
+
+        paths = chunked_paths(output_path, dataset_name, method, windows)
+        positions = {feature: schema.get_field_index(feature) for feature in exogenous_features}
+        output_schema = schema
+        for feature, position in positions.items():
+            output_schema = output_schema.set(position, pa.field(feature, pa.from_numpy_dtype(dtype)))
+        writers = {
+            window: [pq.ParquetWriter(f"{path}.tmp", output_schema, compression="zstd") for path in window_paths]
+            for window, window_paths in paths.items()
+        }
+        rows = chunk_rows or _batch_rows(chunk_bytes, len(schema), windows)
+        row = 0
+        with span("write", file=dataset_name, format="chunked", method=method):
+            saliency_files = {window: np.load(path, mmap_mode="r") for window, path in saliency_paths.items()}
+            for batch in parquet_file.iter_batches(batch_size=rows):
+                exogenous_block = _batch_values(batch, exogenous_features)
+                for window, window_writers in writers.items():
+                    saliency = saliency_files[window][row:row + batch.num_rows]
+                    shaped_blocks = shape_saliency(saliency, exogenous_block, dtype=dtype, saliency_range=ranges[window])
+                    for writer, shaped_block in zip(window_writers, shaped_blocks):
+                        columns = list(batch.columns)
+                        for i, feature in enumerate(exogenous_features):
+                            columns[positions[feature]] = pa.array(shaped_block[:, i])
+                        writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=output_schema))
+                row += batch.num_rows
+            del saliency_files
+        for window, window_writers in writers.items():
+            for writer, path in zip(window_writers, paths[window]):
+                writer.close()
+                os.replace(f"{path}.tmp", path) # NOTE: complete files only
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return paths
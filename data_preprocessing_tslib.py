@@ -4,14 +4,28 @@ from datasetsforecast.long_horizon2 import LongHorizon2
 import pandas as pd
 pd.options.plotting.backend = "plotly"
 from tqdm.notebook import tqdm
-from joblib import Parallel, delayed
-import joblib
 from datasets_metadata import ts_metadata
+from raw_loader import load_dataset
 import contextlib
-from preprocessing_utilities import pfarm, prollcorr, prollcov, pentropy, pmutual_info, pdtw
+from shaping_methods import get_method
+from shared_frame import shared_frame
+from saliency_cache import SaliencyCache
+from grid_scheduler import run_grid
+from telemetry import configure, span, summary
+from preprocessing_utilities import save_df_to_file, save_shaped_partition, assemble_shaped, PARTITIONED
+from split_shaping import dataset_split_bounds, split_jobs, trim_warmup
 warnings.filterwarnings('ignore')
 
 PARALLEL = True
+OUTPUT_FORMAT = ".csv" # ".csv", ".parquet" or PARTITIONED (raw columns once, shaped columns per partition)
+OUTPUT_PATH = "./processed_data"
+CACHE_PATH = "./.saliency_cache" # NOTE: None disables the saliency cache
+CACHE_MAX_BYTES = 20 * 1024**3
+DTW_PARAMS = {} # NOTE: exact DTW. e.g. {"dtw_band": 50, "dtw_stride": 10} opts into a Sakoe-Chiba band and a window stride for pdtw, faster but approximate and not shown in the output names, see pdtw docstring
+STRIDE_PARAMS = {} # NOTE: e.g. {"stride": 10, "stride_interpolation": "linear"} evaluates the DTW and FARM saliency every 10th step only (entropy and MI are always exact), see benchmark.py --stride-check
+PRECISION = "float64" # NOTE: "float32" halves the memory and size of the shaped columns, raw columns stay as loaded
+SPLITS = None # NOTE: e.g. ("train",) or ("train", "valid", "test"): shape and write only these splits of test_size/valid_size, each normalized on its own rows, see split_shaping
+TRACE_PATH = "./telemetry/trace.jsonl" # NOTE: JSON-lines timing spans of the run, None disables tracing
 datasets_names = [
     "ETTh1",
     "ETTh2",
@@ -22,93 +36,124 @@ datasets_names = [
     "TrafficL"
 ]
 
-@contextlib.contextmanager
-def tqdm_joblib(tqdm_object):
-    """Context manager to patch joblib to report into tqdm progress bar given as argument"""
-    class TqdmBatchCompletionCallback(joblib.parallel.BatchCompletionCallBack):
-        def __call__(self, *args, **kwargs):
-            tqdm_object.update(n=self.batch_size)
-            return super().__call__(*args, **kwargs)
-
-    old_batch_callback = joblib.parallel.BatchCompletionCallBack
-    joblib.parallel.BatchCompletionCallBack = TqdmBatchCompletionCallback
-    try:
-        yield tqdm_object
-    finally:
-        joblib.parallel.BatchCompletionCallBack = old_batch_callback
-        tqdm_object.close()
-
-for dataset_name in tqdm(datasets_names, desc="Datasets"):
-
-    ds_file_path = ts_metadata[dataset_name]["relative_path"]
-
-    df_raw = pd.read_csv(ds_file_path)
-
-    df_raw.columns = [str(col) for col in df_raw.columns]
+list_of_methods = [ # NOTE: methods registered in shaping_methods, in order to produce raw dataset, comment all of them
+    "pfarm",
+    "prollcorr",
+    "prollcov",
+    "pentropy",
+    "pmutual_info",
+    "pdtw",
+]
+list_of_process_fns = [get_method(method)["process_fn"] for method in list_of_methods]
 
+def write_results(job, results_processed):
+    dataset_name = job["dataset_name"]
+    process_fn = job["process_fn"]
+    df_raw = raw_datasets[dataset_name]
     target_ts = ts_metadata[dataset_name]["target_ts"]
-    exog_list = ts_metadata[dataset_name]["exog_list"]
-    test_size = ts_metadata[dataset_name]["test_size"]
-    valid_size = ts_metadata[dataset_name]["valid_size"]
-    farm_windows = ts_metadata[dataset_name]["farm_windows"]
-
-    # SHAPING
-    list_of_process_fns = [
-        pfarm,
-        prollcorr,
-        prollcov,
-        pentropy,
-        pmutual_info,
-        # process_dtw,
-    ]
-    
-    list_of_processed_dfs = []
-    for window in tqdm(farm_windows, leave=False, desc="Iterating windows"):
-
+    split = job.get("split")
+    suffix = f"_{split}" if split else ""
+    if split:
+        # NOTE: only the rows of the split, without the warm-up rows before them
+        results_processed = trim_warmup(results_processed, job["warmup"])
+        df_raw = df_raw.iloc[slice(*job["span"])]
+
+    for window in job["params_list"][0]["windows"]:
+
+        if OUTPUT_FORMAT == PARTITIONED:
+            # NOTE: only the shaped columns, the raw ones are stored once per dataset
+            save_shaped_partition(results_processed, OUTPUT_PATH, dataset_name, window, process_fn.__name__, target_feature=target_ts, split=split)
+            save_shaped_partition(results_processed, OUTPUT_PATH, dataset_name, window, process_fn.__name__, inverted=True, target_feature=target_ts, split=split)
+            continue
+
+        with span("assemble", dataset=dataset_name, method=process_fn.__name__, window=window):
+            # NOTE: raw columns shared by reference, no copy of df_raw per variant
+            df_processed = assemble_shaped(df_raw, results_processed, window, target_feature=target_ts)
+            df_processed_inverted = assemble_shaped(df_raw, results_processed, window, inverted=True, target_feature=target_ts)
+
+        df_processed_unique_id = f"w{window}_{process_fn.__name__}"
+        save_df_to_file(df=df_processed, path=OUTPUT_PATH, filename=f"{dataset_name}_{df_processed_unique_id}{suffix}", format=OUTPUT_FORMAT)
+
+        df_processed_unique_id_inverted = f"w{window}_i{process_fn.__name__}"
+        save_df_to_file(df=df_processed_inverted, path=OUTPUT_PATH, filename=f"{dataset_name}_{df_processed_unique_id_inverted}{suffix}", format=OUTPUT_FORMAT)
+
+configure(TRACE_PATH) # NOTE: before any worker pool starts, so the workers trace too
+cache = SaliencyCache(CACHE_PATH, max_bytes=CACHE_MAX_BYTES, dtype=PRECISION) if CACHE_PATH else None
+
+raw_datasets = {}
+open_frames = {} # NOTE: dataset_name -> ExitStack of its shared frame, closed with its last job
+pending_jobs = {}
+
+def dataset_jobs():
+    '''
+    Yields the jobs of one dataset at a time, loading it only when run_grid reaches it
+    '''
+    for dataset_name in tqdm(datasets_names, desc="Datasets"):
+
+        # NOTE: memory-mapped cache under raw/ after the first run, Parquet or CSV before that
+        df_raw = load_dataset(dataset_name)
+
+        target_ts = ts_metadata[dataset_name]["target_ts"]
+        exog_list = ts_metadata[dataset_name]["exog_list"]
+        farm_windows = ts_metadata[dataset_name]["farm_windows"]
+
+        raw_datasets[dataset_name] = df_raw
+        bounds = dataset_split_bounds(dataset_name, len(df_raw)) if SPLITS else None
+        if OUTPUT_FORMAT == PARTITIONED and SPLITS:
+            for split in SPLITS:
+                save_df_to_file(df=df_raw.iloc[slice(*bounds[split])], path=OUTPUT_PATH, filename="raw", format=PARTITIONED, partition={"dataset": dataset_name, "split": split})
+        elif OUTPUT_FORMAT == PARTITIONED:
+            save_df_to_file(df=df_raw, path=OUTPUT_PATH, filename="raw", format=PARTITIONED, partition={"dataset": dataset_name})
+
+        open_frames[dataset_name] = shared_frames.enter_context(contextlib.ExitStack())
+        shared_raw = open_frames[dataset_name].enter_context(shared_frame(df_raw))
+        # NOTE: every task shapes one feature for all windows at once
         rolling_stats_params_list = []
         for feature in exog_list:
             rolling_stats_params_list += [
                 {
-                    "df_raw": df_raw,
-                    "window": window,
+                    "df_raw": shared_raw,
+                    "windows": farm_windows,
                     "target_feature": target_ts,
-                    "exogenous_feature": feature
+                    "exogenous_feature": feature,
+                    "dataset_name": dataset_name, # NOTE: telemetry tag, and the key of the noise draw, see noise_generator
+                    "dtype": PRECISION,
+                    **DTW_PARAMS,
+                    **STRIDE_PARAMS
                 }
             ]
 
-        for process_fn in tqdm(list_of_process_fns, leave=False, desc="Prcessing fns"):
-            
-            if PARALLEL:
-                tqdm_it = tqdm(desc="Parallel Feature engineering processing", total=len(rolling_stats_params_list), leave=False)
-                with tqdm_joblib(tqdm_it) as progress_bar:
-                    results_processed = Parallel(n_jobs=-1)(delayed(process_fn)(param) for param in rolling_stats_params_list)
-                tqdm_it.container.close()
+        jobs = []
+        for process_fn in list_of_process_fns:
+            if SPLITS:
+                # NOTE: one job per (split, window), over the split rows plus window-1 warm-up rows
+                jobs += split_jobs(dataset_name, process_fn, rolling_stats_params_list, bounds, SPLITS)
             else:
-                # SEQUENTIAL PROCESSING
-                results_processed = []
-                for param in tqdm(rolling_stats_params_list, desc="Sequential Feature engineering processing", leave=False):
-                    results_processed += [process_fn(param)]
-                
-            df_processed = df_raw.copy()
-            df_processed_inverted = df_raw.copy()
-
-            for agg_qts_shaped, feature in results_processed:
-                if feature == target_ts:
-                    continue
-
-                qts_shaped = agg_qts_shaped.get("shaped")
-                if qts_shaped is None:
-                    raise Exception(f"No shaped ts provided: {qts_shaped}")
-                
-                df_processed[str(feature)] = qts_shaped
-                
-                qts_shaped_inverted = agg_qts_shaped.get("inverted_shaped")
-
-                df_processed_inverted[str(feature)] = qts_shaped_inverted
-
-
-            df_processed_unique_id = f"w{window}_{process_fn.__name__}"
-            df_processed.to_csv(f"./processed_data/{dataset_name}_{df_processed_unique_id}.csv", index=False)
-
-            df_processed_unique_id_inverted = f"w{window}_i{process_fn.__name__}"
-            df_processed_inverted.to_csv(f"./processed_data/{dataset_name}_{df_processed_unique_id_inverted}.csv", index=False)
\ No newline at end of file
+                jobs += [{"dataset_name": dataset_name, "process_fn": process_fn, "params_list": rolling_stats_params_list}]
+        pending_jobs[dataset_name] = len(jobs)
+        if not jobs:
+            release_dataset(dataset_name)
+        yield jobs
+
+def release_dataset(dataset_name):
+    raw_datasets.pop(dataset_name)
+    open_frames.pop(dataset_name).close()
+
+def write_dataset_results(job, results_processed):
+    write_results(job, results_processed)
+    pending_jobs[job["dataset_name"]] -= 1
+    if pending_jobs[job["dataset_name"]] == 0:
+        release_dataset(job["dataset_name"]) # NOTE: only the datasets with jobs in flight stay in memory
+
+# NOTE: workers map the raw values from one file per dataset instead of receiving a pickled df_raw per task
+with contextlib.ExitStack() as shared_frames:
+    # SHAPING
+    # NOTE: one pool over every dataset, method and feature, outputs are written as soon as a (dataset, method) is done
+    tqdm_it = tqdm(desc="Feature engineering processing", leave=False)
+    run_grid(dataset_jobs(), write_dataset_results, list_of_process_fns, cache=cache, n_jobs=-1 if PARALLEL else 1, progress=tqdm_it)
+    tqdm_it.close()
+
+if cache is not None:
+    print(cache.report())
+if TRACE_PATH:
+    print(summary(TRACE_PATH))
@@ -0,0 +1,82 @@
+from joblib import Parallel, delayed
+
+from saliency_cache import cache_lookup, cache_store
+from shaping_methods import get_method, estimate_cost, backend, process_windows, process_block, block_options
+
+
+def _run_task(task_id, process_fn, params_list):
+    if get_method(process_fn)["batch_columns"]:
+        params = params_list[0]
+        features = [param["exogenous_feature"] for param in params_list]
+        return task_id, process_block(process_fn, params["df_raw"], params["target_feature"], features, params["windows"], **block_options(process_fn, params))
+    return task_id, [process_windows(process_fn, params) for params in params_list]
+
+def _cached_task(task_id):
+    return task_id, None
+
+def run_grid(job_groups, on_complete, process_fns, cache=None, n_jobs=-1, progress=None):
+    '''
+    Runs the whole (dataset x window x method x feature) grid on one worker pool.
+    job_groups yields lists of jobs, typically one list per dataset, and may be a generator: a group is only
+    read (its dataset loaded, its cache entries looked up) when the workers are about to reach it.
+    job = {"dataset_name": dataset_name, "process_fn": process_fn, "params_list": params_list}
+    with params_list as for process_windows (one dict per feature, all windows of the dataset).
+    process_fns holds every method of the grid, to pick the pool backend before any group is read.
+
+    Every job is split into tasks, one per feature or one per job for methods registered with
+    batch_columns, after dropping what the cache already holds. The tasks of a group are ordered longest first
+    by the registered cost models and handed to the workers one at a time as they free up, so there
+    is no barrier between windows, methods or datasets and a slow method never leaves the other cores idle.
+    The workers are threads when every method of the grid is thread safe, processes otherwise.
+    Results stream back as they finish; when a job has all of them, on_complete(job, results_processed)
+    runs in the main process (e.g. writing the outputs) while the workers keep computing, and the job's
+    results are released. A fully cached job is written as soon as it is looked up, its results are never held
+    for the whole grid.
+    '''
+    task_states = {} # NOTE: task_id -> (state, group) of the tasks handed to the pool and not back yet
+
+    def tasks():
+        # NOTE: consumed by joblib as workers free up, so groups are read lazily
+        task_id = 0
+        for jobs in job_groups:
+            group_tasks = []
+            for job in jobs:
+                process_fn = job["process_fn"]
+                results, missing, keys = cache_lookup(cache, process_fn, job["params_list"])
+                state = {"job": job, "results": results, "keys": keys, "pending": 0}
+                if not missing:
+                    # NOTE: a no-op task, so on_complete writes and releases the cached results right away
+                    task_states[task_id] = (state, None)
+                    yield delayed(_cached_task)(task_id)
+                    task_id += 1
+                    continue
+                for missing_windows, indices in missing.items():
+                    groups = [indices] if get_method(process_fn)["batch_columns"] else [[i] for i in indices]
+                    for group in groups:
+                        params_group = [dict(job["params_list"][i], windows=list(missing_windows)) for i in group]
+                        group_tasks += [(estimate_cost(process_fn, params_group), state, group, params_group)]
+                        state["pending"] += 1
+
+            group_tasks.sort(key=lambda task: task[0], reverse=True) # NOTE: longest processing time first
+            if progress is not None:
+                progress.total += len(group_tasks)
+                progress.refresh()
+            for _, state, group, params_group in group_tasks:
+                task_states[task_id] = (state, group)
+                yield delayed(_run_task)(task_id, state["job"]["process_fn"], params_group)
+                task_id += 1
+
+    if progress is not None:
+        progress.reset(total=0)
+    outputs = Parallel(n_jobs=n_jobs, backend=backend(process_fns), batch_size=1, return_as="generator_unordered")(tasks())
+    for task_id, results_processed in outputs:
+        state, group = task_states.pop(task_id)
+        if results_processed is not None:
+            for i, (windows_shaped, _) in zip(group, results_processed):
+                cache_store(cache, state["keys"], state["results"], i, windows_shaped)
+            state["pending"] -= 1
+            if progress is not None:
+                progress.update(1)
+        if state["pending"] == 0:
+            on_complete(state["job"], state["results"])
+            state["results"] = None # NOTE: release the job's results once written
@@ -0,0 +1,184 @@
+import os
+import json
+
+import numpy as np
+from joblib import Parallel, delayed
+from pyinform.utils.coalesce import coalesce_series
+
+from preprocessing_utilities import _rolling_state_sums, _plogp
+from shaping_methods import get_method, backend
+from telemetry import span
+
+PAIR_TILE = 32 # NOTE: columns per tile side, a (32 x 32) float64 tile row is 8 KiB and stays in L1/L2 while accumulating over time
+TILE_BYTES = 64 * 1024**2 # NOTE: working set of one tile task, bounds the memory of every worker
+
+
+def _tiles(n_columns, tile_size):
+    # NOTE: upper triangle only, every measure is symmetric and tiles are mirrored on write
+    starts = range(0, n_columns, tile_size)
+    return [
+        (slice(i, min(i + tile_size, n_columns)), slice(j, min(j + tile_size, n_columns)))
+        for i in starts for j in starts if j >= i
+    ]
+
+def _column_prefixes(values):
+    '''
+    Per-column prefix sums shared by every tile: valid counts, centred values and their squares,
+    and the number of value changes (to spot constant windows), as in _prefix_sums.
+    '''
+    valid = ~np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        centred = np.where(valid, values - np.nanmean(values, axis=0), 0.0)
+    prefix = {}
+    for name, columns in (("n", valid), ("x", centred), ("xx", centred * centred)):
+        prefix[name] = np.concatenate((np.zeros((1, values.shape[1])), np.cumsum(columns, axis=0, dtype=np.float64)))
+    steps = np.cumsum(values[1:] != values[:-1], axis=0)
+    prefix["steps"] = np.concatenate((np.zeros((1, values.shape[1]), dtype=steps.dtype), steps))
+    return centred, prefix
+
+def _column_moments(prefix, columns, window, rows):
+    # NOTE: window sums of one column tile for the windows ending at rows
+    sums = {name: prefix[name][rows + 1, columns] - prefix[name][rows + 1 - window, columns] for name in ("n", "x", "xx")}
+    full = np.round(sums["n"]) == window
+    flat = prefix["steps"][rows, columns] == prefix["steps"][rows + 1 - window, columns]
+    var = np.where(flat, 0, np.maximum((sums["xx"] - sums["x"] ** 2 / window) / (window - 1), 0))
+    return sums["x"], var, full, flat
+
+def _moments_tile(centred, prefix, rows_i, rows_j, window, chunk):
+    '''
+    Rolling covariance and variances of every (i, j) column pair of a tile, for the window ends in chunk.
+    Only the cross products are per pair: they are summed over chunk plus the window-1 rows before it,
+    so the tile never holds more than (len(chunk) + window) x i x j values.
+    '''
+    lo = chunk.start - window + 1
+    products = centred[lo:chunk.stop, rows_i, None] * centred[lo:chunk.stop, None, rows_j]
+    cross = np.concatenate((np.zeros((1,) + products.shape[1:]), np.cumsum(products, axis=0)))
+    del products
+    sums_xy = cross[window:] - cross[:-window]
+    del cross
+
+    rows = np.arange(chunk.start, chunk.stop)
+    sums_x, var_x, full_x, flat_x = _column_moments(prefix, rows_i, window, rows)
+    sums_y, var_y, full_y, flat_y = _column_moments(prefix, rows_j, window, rows)
+    flat = flat_x[:, :, None] | flat_y[:, None, :]
+    cov = np.where(flat, 0, (sums_xy - sums_x[:, :, None] * sums_y[:, None, :] / window) / (window - 1))
+    full = full_x[:, :, None] & full_y[:, None, :]
+    return np.where(full, cov, np.nan), np.where(full_x, var_x, np.nan), np.where(full_y, var_y, np.nan)
+
+def _corr_tile(centred, prefix, rows_i, rows_j, window, chunk):
+    cov, var_x, var_y = _moments_tile(centred, prefix, rows_i, rows_j, window, chunk)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return cov / np.sqrt(var_x[:, :, None] * var_y[:, None, :])
+
+def _cov_tile(centred, prefix, rows_i, rows_j, window, chunk):
+    return _moments_tile(centred, prefix, rows_i, rows_j, window, chunk)[0]
+
+def _write_tile(path, rows_i, rows_j, first_row, tile):
+    # NOTE: tile is (time, i, j), the output (i, j, time); the mirrored (j, i) block is written too
+    out = np.load(path, mmap_mode="r+")
+    out[rows_i, rows_j, first_row:first_row + tile.shape[0]] = tile.transpose(1, 2, 0)
+    out[rows_j, rows_i, first_row:first_row + tile.shape[0]] = tile.transpose(2, 1, 0)
+    del out # NOTE: no flush per tile, the pages are written back when unmapped
+
+def _moments_task(tile_fn, centred, prefix, rows_i, rows_j, windows, paths, tile_bytes):
+    for window in windows:
+        # NOTE: products, cumsum and result of one chunk, all (rows, i, j) float64
+        chunk_rows = max(tile_bytes // (3 * 8 * (rows_i.stop - rows_i.start) * (rows_j.stop - rows_j.start)) - window, window)
+        for start in range(window - 1, centred.shape[0], chunk_rows):
+            chunk = slice(start, min(start + chunk_rows, centred.shape[0]))
+            _write_tile(paths[window], rows_i, rows_j, chunk.start, tile_fn(centred, prefix, rows_i, rows_j, window, chunk))
+
+def _mutual_info_task(states, column_sums, rows_i, rows_j, windows, paths, tile_bytes):
+    '''
+    Rolling mutual information of every (i, j) column pair of a tile, one window and one time chunk at a time:
+    the joint states of a pair are summed over the chunk plus the window-1 rows before it, so the tile never
+    holds more than tile_bytes of results, as in _moments_task.
+    '''
+    n = states.shape[0]
+    bases = states.max(axis=0).astype(np.int64) + 1
+    n_i, n_j = rows_i.stop - rows_i.start, rows_j.stop - rows_j.start
+    for window in windows:
+        chunk_rows = max(tile_bytes // (8 * n_i * n_j) - window, window)
+        for start in range(window - 1, n, chunk_rows):
+            chunk = slice(start, min(start + chunk_rows, n))
+            lo = chunk.start - window + 1
+            tile = np.empty((chunk.stop - chunk.start, n_i, n_j))
+            for a, i in enumerate(range(rows_i.start, rows_i.stop)):
+                for b, j in enumerate(range(rows_j.start, rows_j.stop)):
+                    if j < i and rows_i == rows_j:
+                        continue # NOTE: diagonal tiles are symmetric, the lower half is copied below
+                    joint = states[lo:chunk.stop, i].astype(np.int64) * bases[j] + states[lo:chunk.stop, j]
+                    (sums_joint,) = _rolling_state_sums([joint], [window], [_plogp])[window]
+                    # NOTE: column_sums rows are window starts, lo is the start of the window ending at chunk.start
+                    sums_i = column_sums[window][lo:chunk.stop - window + 1, i]
+                    sums_j = column_sums[window][lo:chunk.stop - window + 1, j]
+                    tile[:, a, b] = np.log2(window) - (sums_i + sums_j - sums_joint) / window
+            if rows_i == rows_j:
+                lower = np.tril_indices(n_i, -1)
+                tile[:, lower[0], lower[1]] = tile[:, lower[1], lower[0]]
+            _write_tile(paths[window], rows_i, rows_j, chunk.start, tile)
+
+PAIRWISE_TILE_FNS = {
+    "prollcorr": _corr_tile,
+    "prollcov": _cov_tile,
+    "pmutual_info": None, # NOTE: per pair joint states, see _mutual_info_task
+}
+
+def pairwise_paths(path, method, windows):
+    return {window: os.path.join(path, f"{method}_w{window}.npy") for window in windows}
+
+def pairwise_saliency(df_raw, method, windows, path, columns=None, dtype=np.float64, tile_size=PAIR_TILE, tile_bytes=TILE_BYTES, n_jobs=-1):
+    '''
+    ALL-PAIRS SALIENCY
+    Rolling saliency of every column of df_raw against every other one, for method "prollcorr",
+    "prollcov" or "pmutual_info", as the pair functions compute it for one (target, exogenous) pair.
+    For each window the (k, k, n) tensor is written to {path}/{method}_w{window}.npy, saliency[i, j]
+    being the rolling series of (columns[i], columns[j]), NaN before the first full window.
+    Per-column work (centred prefix sums, coalesced states and their entropies) is done once; only the
+    cross terms are per pair. Pairs are computed in tile_size x tile_size column tiles of the upper triangle
+    (the measures are symmetric), each tile over time chunks bounded by tile_bytes, one tile per task.
+    Returns ({window: read-only memmap}, columns), also readable later with load_pairwise.
+    '''
+    if method not in PAIRWISE_TILE_FNS:
+        raise ValueError(f"No all-pairs mode for {method}, available: {list(PAIRWISE_TILE_FNS)}")
+    columns = [str(column) for column in (columns or df_raw.select_dtypes("number").columns)]
+    values = np.asarray(df_raw[columns].to_numpy(dtype=np.float64), order="F")
+    n, n_columns = values.shape
+    if max(windows) > n:
+        raise ValueError("window shape cannot be larger than input array shape")
+
+    os.makedirs(path, exist_ok=True)
+    paths = pairwise_paths(path, method, windows)
+    for window in windows:
+        out = np.lib.format.open_memmap(f"{paths[window]}.tmp", mode="w+", dtype=dtype, shape=(n_columns, n_columns, n))
+        out[:, :, :window - 1] = np.nan
+        del out
+    with open(os.path.join(path, f"{method}_columns.json"), "w") as file:
+        json.dump(columns, file)
+
+    tmp_paths = {window: f"{paths[window]}.tmp" for window in windows}
+    tiles = _tiles(n_columns, tile_size)
+    with span("pairwise", method=method, feature=f"{n_columns} columns", window=",".join(str(window) for window in windows)):
+        if method == "pmutual_info":
+            states = np.column_stack([coalesce_series(values[:, column])[0] for column in range(n_columns)])
+            column_sums = {window: np.empty((n - window + 1, n_columns)) for window in windows}
+            for column in range(n_columns):
+                for window, (sums,) in _rolling_state_sums([states[:, column].astype(np.int64)], windows, [_plogp]).items():
+                    column_sums[window][:, column] = sums
+            tasks = (delayed(_mutual_info_task)(states, column_sums, rows_i, rows_j, windows, tmp_paths, tile_bytes) for rows_i, rows_j in tiles)
+        else:
+            centred, prefix = _column_prefixes(values)
+            tasks = (delayed(_moments_task)(PAIRWISE_TILE_FNS[method], centred, prefix, rows_i, rows_j, windows, tmp_paths, tile_bytes) for rows_i, rows_j in tiles)
+        Parallel(n_jobs=n_jobs, backend=backend([get_method(method)["process_fn"]]))(tasks)
+
+    for window in windows:
+        os.replace(tmp_paths[window], paths[window]) # NOTE: complete files only
+    return {window: np.load(paths[window], mmap_mode="r") for window in windows}, columns
+
+def load_pairwise(path, method, window):
+    '''
+    (read-only memmap, columns) of a tensor written by pairwise_saliency
+    '''
+    with open(os.path.join(path, f"{method}_columns.json")) as file:
+        columns = json.load(file)
+    return np.load(pairwise_paths(path, method, [window])[window], mmap_mode="r"), columns
@@ -3,23 +3,503 @@ from tqdm.notebook import tqdm
 
 from PyFARM import farm
 
-from dtaidistance import dtw
+from dtaidistance import dtw_cc_omp
 
-from scipy.spatial.distance import euclidean
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 
-from pyinform.relativeentropy import relative_entropy
-from pyinform.mutualinfo import mutual_info
 from pyinform.utils.coalesce import coalesce_series
 
+import os
+import hashlib
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from numpy.lib.stride_tricks import sliding_window_view
+from joblib import Parallel, delayed
 
-from scipy.stats import skewnorm
+from telemetry import span
 
 warnings.filterwarnings('once')
 
+PARTITIONED = "partitioned" # NOTE: output format of save_df_to_file for hive-partitioned Parquet trees
+ROW_GROUP_SIZE = 65536
+
+def _partition_directory(path, filename, partition):
+    return os.path.join(path, filename, *[f"{key}={value}" for key, value in partition.items()])
+
+def save_df_to_file(df, path, filename, format=".csv", partition=None, row_group_size=ROW_GROUP_SIZE):
+    '''
+    Saves df as {path}/{filename}.csv or {path}/{filename}.parquet.
+    With format=PARTITIONED, df is streamed in row groups to
+    {path}/{filename}/key=value/.../part-0.parquet for each key, value of partition,
+    so a dataset can store its raw columns once and each shaped variant as its own partition.
+    '''
+    with span("write", file=filename, format=format):
+        if format == ".csv":
+            os.makedirs(path, exist_ok=True)
+            df.to_csv(os.path.join(path, f"{filename}.csv"), index=False)
+        elif format == ".parquet":
+            os.makedirs(path, exist_ok=True)
+            df.to_parquet(os.path.join(path, f"{filename}.parquet"), index=False)
+        elif format == PARTITIONED:
+            directory = _partition_directory(path, filename, partition or {})
+            os.makedirs(directory, exist_ok=True)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with pq.ParquetWriter(os.path.join(directory, "part-0.parquet"), table.schema, compression="zstd") as writer:
+                for batch in table.to_batches(max_chunksize=row_group_size):
+                    writer.write_table(pa.Table.from_batches([batch], schema=table.schema))
+        else:
+            raise ValueError(f"Unknown output format: {format}")
+
+def save_shaped_partition(results_processed, path, dataset_name, window, method, inverted=False, target_feature=None, split=None):
+    '''
+    Saves only the shaped columns of one (window, method, inverted) variant as a PARTITIONED partition,
+    from the [({window: {"shaped", "inverted_shaped"}}, exogenous_feature)] results of process_windows.
+    With split (see split_shaping) the variant of that split's rows goes to its own split=... partition.
+    '''
+    key = "inverted_shaped" if inverted else "shaped"
+    df = pd.DataFrame({
+        str(feature): np.asarray(windows_qts_shaped[window][key])
+        for windows_qts_shaped, feature in results_processed
+        if feature != target_feature
+    })
+    partition = {"dataset": dataset_name, "window": window, "method": method, "inverted": inverted}
+    if split is not None:
+        partition["split"] = split
+    save_df_to_file(df, path, "shaped", format=PARTITIONED, partition=partition)
+
+def assemble_shaped(df_raw, results_processed, window, inverted=False, target_feature=None):
+    '''
+    One shaped (window, inverted) variant of df_raw, from the [({window: {"shaped", "inverted_shaped"}}, exogenous_feature)]
+    results of process_windows, built with a single constructor call: the raw columns are shared with df_raw
+    and the shaped ones are the result arrays themselves, so nothing is copied and no column is assigned one
+    at a time. Peak memory stays at df_raw plus the results. Modify a column of the variant only after copying it.
+    A missing inverted series gives a column of None, a missing shaped series raises.
+    '''
+    key = "inverted_shaped" if inverted else "shaped"
+    shaped = {}
+    for windows_qts_shaped, feature in results_processed:
+        if feature == target_feature:
+            continue
+        qts_shaped = windows_qts_shaped[window].get(key)
+        if qts_shaped is None and not inverted:
+            raise Exception(f"No shaped ts provided: {qts_shaped}")
+        if qts_shaped is None:
+            shaped[str(feature)] = np.full(len(df_raw), None, dtype=object)
+        else:
+            shaped[str(feature)] = np.asarray(qts_shaped) # NOTE: positional, results share df_raw.index
+            if shaped[str(feature)].shape != (len(df_raw),):
+                raise ValueError(f"Shaped {feature} has {shaped[str(feature)].shape} values for {len(df_raw)} rows")
+
+    columns = {str(column): shaped.pop(str(column), df_raw[column]) for column in df_raw.columns}
+    columns.update(shaped) # NOTE: features missing from df_raw are appended, as column assignment would
+    return pd.DataFrame(columns, index=df_raw.index, copy=False)
+
+def load_shaped_df(path, dataset_name, window, method, inverted=False, split=None):
+    '''
+    Rebuilds one shaped variant written with save_df_to_file(format=PARTITIONED): the raw
+    columns of the dataset with the shaped columns of the (window, method, inverted) partition.
+    With split, only the files of that split are read. A dataset written with splits must be read one split
+    at a time: each split is normalized on its own rows, so there is no single variant of the whole series.
+    '''
+    if split is None:
+        splits = sorted(entry[len("split="):] for entry in os.listdir(_partition_directory(path, "raw", {"dataset": dataset_name})) if entry.startswith("split="))
+        if splits:
+            raise ValueError(f"{dataset_name} was written with splits, pass one of split={splits}")
+    raw_partition = {"dataset": dataset_name} if split is None else {"dataset": dataset_name, "split": split}
+    df = pd.read_parquet(_partition_directory(path, "raw", raw_partition))
+    shaped_partition = {"dataset": dataset_name, "window": window, "method": method, "inverted": inverted}
+    if split is not None:
+        shaped_partition["split"] = split
+    shaped = pd.read_parquet(_partition_directory(path, "shaped", shaped_partition))
+    df[list(shaped.columns)] = shaped.to_numpy()
+    return df
+
+def _state_keys(states):
+    # NOTE: sorted (state, position) keys, so counting a state inside any window is two binary searches
+    n = states.size
+    return np.sort(states.astype(np.int64) * n + np.arange(n))
+
+def _window_counts(keys, queried_states, ends, window):
+    # NOTE: occurrences of each queried state in the window (end - window, end]
+    n = keys.size
+    query = queried_states.astype(np.int64) * n + ends
+    return np.searchsorted(keys, query, side="right") - np.searchsorted(keys, query - window, side="right")
+
+def _rolling_state_sums(series, windows, terms):
+    '''
+    Rolling sums over states of term(count_0, ..., count_k) for every term and window, where
+    count_i is the histogram of series[i] over the current window. Only the states entering or
+    leaving the window change the sums, so each step updates a few counts instead of re-histogramming the window.
+    Each count is two binary searches in the sorted state keys, an O(log n) step and O(n log n) per window.
+    The sorted state keys are built once and shared by all windows.
+    Every term must be zero for all-zero counts.
+    Returns {window: [sums_of_term_0, sums_of_term_1, ...]}
+    '''
+    n = series[0].size
+    if max(windows) > n:
+        raise ValueError("window shape cannot be larger than input array shape")
+    n_states = max(int(s.max()) for s in series) + 1
+    keys = [_state_keys(s) for s in series]
+
+    sums = {}
+    for window in windows:
+        first_counts = [np.bincount(s[:window], minlength=n_states) for s in series]
+        firsts = [term(*first_counts).sum() for term in terms]
+
+        ends = np.arange(window, n)
+        candidates = [s[ends] for s in series] + [s[ends - window] for s in series]
+        deltas = [0] * len(terms)
+        for i, state in enumerate(candidates):
+            counts_now = [_window_counts(k, state, ends, window) for k in keys]
+            counts_before = [_window_counts(k, state, ends - 1, window) for k in keys]
+            already_seen = np.zeros(ends.size, dtype=bool)
+            for other in candidates[:i]:
+                already_seen |= state == other # NOTE: a state touched twice in one step is updated once
+            for j, term in enumerate(terms):
+                deltas[j] = deltas[j] + np.where(already_seen, 0, term(*counts_now) - term(*counts_before))
+
+        sums[window] = [np.concatenate(([first], first + np.cumsum(delta)))
+                        if ends.size > 0 else np.array([first])
+                        for first, delta in zip(firsts, deltas)]
+    return sums
+
+SALIENCY_INTERPOLATIONS = ("linear", "step")
+
+def saliency_stride(params):
+    '''
+    (stride, interpolation) asked for by params["stride"] and params["stride_interpolation"], (1, "linear") by default
+    '''
+    stride = int(params.get("stride", 1))
+    interpolation = params.get("stride_interpolation", "linear")
+    if stride < 1:
+        raise ValueError(f"stride must be at least 1, got {stride}")
+    if interpolation not in SALIENCY_INTERPOLATIONS:
+        raise ValueError(f"Unknown stride interpolation {interpolation}, available: {SALIENCY_INTERPOLATIONS}")
+    return stride, interpolation
+
+def strided_saliency(measure, n_windows, stride, interpolation="linear"):
+    '''
+    Saliency of n_windows sliding windows with measure(starts) evaluated only at every stride-th
+    window start (and the last one). The others are interpolated linearly, or hold the last
+    evaluated value with interpolation="step". stride=1 evaluates every window.
+    '''
+    if n_windows <= 0:
+        raise ValueError("window shape cannot be larger than input array shape")
+    starts = np.arange(0, n_windows, stride)
+    if starts[-1] != n_windows - 1:
+        starts = np.append(starts, n_windows - 1)
+    values = np.asarray(measure(starts), dtype=np.float64)
+    if starts.size == n_windows:
+        return values
+    if interpolation == "step":
+        return values[np.searchsorted(starts, np.arange(n_windows), side="right") - 1]
+    if values.ndim == 2: # NOTE: one column per feature, see rolling_dtw
+        return np.column_stack([np.interp(np.arange(n_windows), starts, column) for column in values.T])
+    return np.interp(np.arange(n_windows), starts, values)
+
+def _plogp(counts):
+    return np.where(counts > 0, counts * np.log2(np.maximum(counts, 1)), 0.0)
+
+def multi_window_relative_entropy(xs, ys, windows):
+    '''
+    Relative entropy D(xs || ys) of every sliding window, in bits, for each window length.
+    The rolling pass costs O(n log n) whatever the window, so there is no strided variant:
+    evaluating every stride-th window directly costs O(n * window / stride log n), slower than
+    the exact pass for any stride short of the window itself.
+    Returns {window: array of len(xs) - window + 1 values}
+    '''
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+
+    def cross(p, q):
+        return np.where((p > 0) & (q > 0), p * np.log2(np.maximum(q, 1)), 0.0)
+
+    def unsupported(p, q):
+        return ((p > 0) & (q == 0)).astype(np.int64)
+
+    def entropy(window, plogp, plogq, n_unsupported):
+        result = (plogp - plogq) / window
+        result[n_unsupported > 0] = np.nan # NOTE: posterior mass where the prior has none, as pyinform
+        return result
+
+    sums = _rolling_state_sums([xs, ys], windows, [lambda p, q: _plogp(p), cross, unsupported])
+    return {window: entropy(window, *sums[window]) for window in windows}
+
+def multi_window_mutual_info(xs, ys, windows):
+    '''
+    Mutual information of every sliding window, in bits, for each window length.
+    One O(n log n) rolling pass, as multi_window_relative_entropy.
+    Returns {window: array of len(xs) - window + 1 values}
+    '''
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    joint = xs * (int(ys.max()) + 1) + ys
+
+    sums_x, sums_y, sums_joint = [_rolling_state_sums([s], windows, [_plogp]) for s in (xs, ys, joint)]
+    return {
+        window: np.log2(window) - (sums_x[window][0] + sums_y[window][0] - sums_joint[window][0]) / window
+        for window in windows
+    }
+
+def rolling_relative_entropy(xs, ys, window):
+    '''
+    Relative entropy D(xs || ys) of every sliding window, in bits.
+    Same values as [relative_entropy(a, b) for a, b in zip(sliding_window_view(xs, window), sliding_window_view(ys, window))]
+    '''
+    return multi_window_relative_entropy(xs, ys, [window])[window]
+
+def rolling_mutual_info(xs, ys, window):
+    '''
+    Mutual information of every sliding window, in bits.
+    Same values as [mutual_info(a, b) for a, b in zip(sliding_window_view(xs, window), sliding_window_view(ys, window))]
+    '''
+    return multi_window_mutual_info(xs, ys, [window])[window]
+
+def _prefix_sums(xs, ys):
+    '''
+    Prefix sums for rolling moments of xs (n,) against ys (n,) or a column block (n, k).
+    '''
+    xs = xs.reshape((-1,) + (1,) * (ys.ndim - 1))
+    missing = np.isnan(xs) | np.isnan(ys)
+    # NOTE: centring before accumulating keeps the prefix differences well conditioned
+    if missing.any():
+        valid = ~missing
+        x = np.where(valid, xs - np.nanmean(xs), 0.0)
+        y = np.where(valid, ys - np.nanmean(ys, axis=0), 0.0)
+    else:
+        valid = np.ones_like(xs, dtype=bool)
+        x = xs - xs.mean()
+        y = ys - ys.mean(axis=0)
+
+    prefix = {}
+    for name, values in (("n", valid), ("x", x), ("y", y), ("xx", x * x), ("yy", y * y), ("xy", x * y)):
+        prefix[name] = np.concatenate((np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0, dtype=np.float64)))
+    for name, values in (("x_steps", xs), ("y_steps", ys)):
+        steps = np.cumsum(values[1:] != values[:-1], axis=0)
+        prefix[name] = np.concatenate((np.zeros((1,) + values.shape[1:], dtype=steps.dtype), steps))
+    return prefix
+
+def _rolling_moments(prefix, window):
+    '''
+    Rolling sample covariance and variances (ddof=1) from shared prefix sums, NaN-padded
+    to full length like pandas rolling(window), and NaN where a window holds missing values.
+    '''
+    sums = {name: prefix[name][window:] - prefix[name][:-window] for name in ("n", "x", "y", "xx", "yy", "xy")}
+    full = np.round(sums["n"]) == window
+    # NOTE: constant windows are exactly zero-variance, not prefix-sum rounding noise
+    flat_x = prefix["x_steps"][window - 1:] == prefix["x_steps"][:1 - window or None]
+    flat_y = prefix["y_steps"][window - 1:] == prefix["y_steps"][:1 - window or None]
+
+    cov = np.where(flat_x | flat_y, 0, (sums["xy"] - sums["x"] * sums["y"] / window) / (window - 1))
+    var_x = np.where(flat_x, 0, np.maximum((sums["xx"] - sums["x"] ** 2 / window) / (window - 1), 0))
+    var_y = np.where(flat_y, 0, np.maximum((sums["yy"] - sums["y"] ** 2 / window) / (window - 1), 0))
+
+    moments = []
+    for values in (cov, var_x, var_y):
+        values = np.where(full, values, np.nan)
+        moments += [np.concatenate((np.full((window - 1,) + values.shape[1:], np.nan), values))]
+    return moments
+
+def multi_window_corr(xs, ys, windows):
+    '''
+    Rolling Pearson correlation for each window length, sharing one set of prefix sums.
+    ys can be a single series or a (n, k) block of series, each correlated with xs.
+    Returns {window: array shaped like ys}, as pd.Series(xs).rolling(window).corr(pd.Series(ys)) except that
+    a window where xs or ys is constant is NaN, the correlation being undefined, where pandas gives ±inf or rounding noise.
+    '''
+    prefix = _prefix_sums(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    results = {}
+    for window in windows:
+        cov, var_x, var_y = _rolling_moments(prefix, window)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            results[window] = cov / np.sqrt(var_x * var_y)
+        results[window] = results[window].reshape(np.shape(ys))
+    return results
+
+def multi_window_cov(xs, ys, windows):
+    '''
+    Rolling sample covariance for each window length, sharing one set of prefix sums.
+    ys can be a single series or a (n, k) block of series, each paired with xs.
+    Returns {window: array shaped like ys}, as pd.Series(xs).rolling(window).cov(pd.Series(ys)) up to rounding,
+    a window where xs or ys is constant being exactly 0.
+    '''
+    prefix = _prefix_sums(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    return {window: _rolling_moments(prefix, window)[0].reshape(np.shape(ys)) for window in windows}
+
+def _dtw_windows(xs, ys, window, starts, band):
+    # NOTE: dtaidistance has no batch call for paired windows, only blocks of a distance matrix: each start is
+    # one C call on the 1 x k block (target window against every exogenous window), run outside the GIL and
+    # over the k columns with OpenMP. Exact DTW, so no pruning and no euclidean fallback for its inf results
+    ys_block = ys.reshape(len(ys), -1)
+    n_columns = ys_block.shape[1]
+    settings = {} if band is None else {"window": band}
+    series = np.empty((n_columns + 1, window), dtype=np.double)
+    dists = np.empty((len(starts), n_columns))
+    for i, start in enumerate(starts):
+        series[0] = xs[start:start + window]
+        series[1:] = ys_block[start:start + window].T
+        dists[i] = dtw_cc_omp.distance_matrix(series, block=((0, 1), (1, n_columns + 1)), **settings)
+    return dists.reshape((len(starts),) + ys.shape[1:])
+
+def rolling_dtw(xs, ys, window, band=None, stride=1, n_jobs=1, interpolation="linear"):
+    '''
+    DTW distance of every sliding window pair, optionally constrained to a Sakoe-Chiba band of
+    `band` steps. ys may be an (n, k) block, every column then being paired with xs in the same C calls.
+    With stride > 1 only every stride-th window (and the last one) is evaluated and
+    the others are interpolated (see strided_saliency). With n_jobs != 1 the evaluated windows are split into
+    contiguous chunks over a process pool, each worker receiving only the rows of its chunk.
+    Returns an array of len(xs) - window + 1 values, (len(xs) - window + 1, k) for a block.
+    '''
+    xs = np.asarray(xs, dtype=np.double)
+    ys = np.asarray(ys, dtype=np.double)
+
+    def dists(starts):
+        if n_jobs == 1:
+            return _dtw_windows(xs, ys, window, starts, band)
+        chunks = [chunk for chunk in np.array_split(starts, 4 * (os.cpu_count() if n_jobs == -1 else n_jobs)) if chunk.size > 0]
+        return np.concatenate(Parallel(n_jobs=n_jobs)(
+            delayed(_dtw_windows)(xs[chunk[0]:chunk[-1] + window], ys[chunk[0]:chunk[-1] + window], window, chunk - chunk[0], band)
+            for chunk in chunks
+        ))
+
+    return strided_saliency(dists, xs.size - window + 1, stride, interpolation)
+
+def rolling_lb_keogh(xs, ys, window, band=None):
+    '''
+    LB_Keogh lower bound of the DTW distance (same scale as dtw.distance) of every sliding window pair.
+    The envelope of ys is a single sliding min/max pass over the whole series, shared by all windows,
+    and the per-window sums come from one prefix sum, so the whole series costs O(n).
+    The envelope is not clipped at the window edges, which only loosens the bound.
+    '''
+    xs = np.asarray(xs, dtype=np.double)
+    ys = np.asarray(ys, dtype=np.double)
+    if window > xs.size:
+        raise ValueError("window shape cannot be larger than input array shape")
+    size = 2 * (window - 1 if band is None else band) + 1
+    upper = maximum_filter1d(ys, size, mode="nearest")
+    lower = minimum_filter1d(ys, size, mode="nearest")
+    excess = np.where(xs > upper, xs - upper, np.where(xs < lower, xs - lower, 0)) ** 2
+    prefix = np.concatenate(([0.0], np.cumsum(excess)))
+    return np.sqrt(np.maximum(prefix[window:] - prefix[:-window], 0))
+
+SHAPED_DTYPES = ("float64", "float32")
+FLOAT32_TOLERANCE = 1e-6 # NOTE: max |float32 - float64| shaped value over the max |value| of the column, see benchmark.py --precision-check
+
+def shaped_dtype(params):
+    '''
+    dtype of the shaped series asked for by params["dtype"], float64 by default.
+    Saliencies are always computed with float64 accumulators; only the stored shaped (and inverted)
+    series are rounded, so float32 results stay within FLOAT32_TOLERANCE of the float64 ones.
+    '''
+    dtype = np.dtype(params.get("dtype", np.float64))
+    if dtype.name not in SHAPED_DTYPES:
+        raise ValueError(f"Unsupported shaped dtype {dtype}, available: {SHAPED_DTYPES}")
+    return dtype
+
+def shape_saliency(saliency, exogenous_values, normalize=True, offset=0, out=None, dtype=np.float64, saliency_range=None):
+    '''
+    Shaping tail shared by every method, on NumPy buffers:
+    shaping_ratio = (saliency - min)/(max - min), inverted = |shaping_ratio - 1|, NaN ratios become 1,
+    returns (exogenous_values * shaping_ratio, exogenous_values * inverted).
+    saliency may be a series or a (n, k) block normalized column-wise, and covers the rows from offset on
+    (earlier rows keep their value, as a NaN saliency would). normalize=False takes the saliency as the ratio
+    itself, as pfarm does. saliency_range=(min, max) normalizes with a range found beforehand instead of
+    the saliency's own, so a chunk of rows is shaped as the whole series would be (see chunked_shaper).
+    Both results are written into out=(shaped, inverted) if given, or into two new dtype arrays,
+    with one min/max reduction and no other full-length temporary than a NaN mask. out may alias saliency.
+    '''
+    exogenous_values = np.asarray(exogenous_values)
+    if out is None:
+        out = (np.empty(exogenous_values.shape, dtype=dtype), np.empty(exogenous_values.shape, dtype=dtype))
+    shaped, inverted = out
+    shaping_ratio = shaped[offset:]
+    shaping_ratio_inverted = inverted[offset:]
+
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning) # NOTE: all-NaN saliency ends up as ratio 1
+        if normalize:
+            if saliency_range is None:
+                saliency_min = np.nanmin(saliency, axis=0)
+                saliency_max = np.nanmax(saliency, axis=0)
+            else:
+                saliency_min, saliency_max = saliency_range
+            np.subtract(saliency, saliency_min, out=shaping_ratio)
+            np.divide(shaping_ratio, saliency_max - saliency_min, out=shaping_ratio) # normalizing between 0 and 1
+        elif not np.may_share_memory(shaping_ratio, saliency): # NOTE: pfarm_block shapes its saliency in place
+            np.copyto(shaping_ratio, saliency, casting="same_kind")
+        np.subtract(shaping_ratio, 1, out=shaping_ratio_inverted)
+        np.abs(shaping_ratio_inverted, out=shaping_ratio_inverted) # NOTE: INVERTING
+
+    undefined = np.isnan(shaping_ratio) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
+    np.copyto(shaping_ratio, 1, where=undefined)
+    np.copyto(shaping_ratio_inverted, 1, where=undefined)
+    shaped[:offset] = 1
+    inverted[:offset] = 1
+
+    np.multiply(shaped, exogenous_values, out=shaped, casting="same_kind")
+    np.multiply(inverted, exogenous_values, out=inverted, casting="same_kind")
+    return shaped, inverted
+
+def shape_series(df_raw, exogenous_feature, saliency, normalize=True, offset=0, dtype=np.float64):
+    '''
+    shape_saliency for one feature of df_raw, returns {"shaped", "inverted_shaped"} dtype Series on df_raw.index
+    '''
+    exogenous_feature = str(exogenous_feature)
+    shaped, inverted = shape_saliency(saliency, df_raw[exogenous_feature].values, normalize=normalize, offset=offset, dtype=dtype)
+    return {
+        "shaped": pd.Series(shaped, index=df_raw.index, name=exogenous_feature, copy=False),
+        "inverted_shaped": pd.Series(inverted, index=df_raw.index, name=exogenous_feature, copy=False)
+    }
+
+def _farm(target_values, exogenous_values, window):
+    return np.asarray(farm(
+        refTS=target_values,
+        qryTS=exogenous_values,
+        ff_align=False,
+        lcwin=window,
+        fuzzyc=[1]
+    )["rel_local_fuzz"], dtype=np.float64)
+
+def _farm_strided(target_values, exogenous_values, window, stride, interpolation="linear"):
+    # NOTE: FARM is one call over the whole series, so the stride decimates the series (and lcwin) instead of the windows
+    return strided_saliency(
+        lambda rows: _farm(target_values[rows], exogenous_values[rows], max(window // stride, 1)),
+        len(target_values), stride, interpolation
+    )
+
+def pfarm_block(target_values, exogenous_block, windows, n_jobs=-1, dtype=np.float64, stride=1, interpolation="linear", dataset="", features=None):
+    '''
+    FARM SHAPING OF A WHOLE EXOGENOUS BLOCK
+    Every (window, exogenous column) pair is one FARM call over the whole series and one task of a
+    single process pool, so the result is exactly pfarm's for each column.
+    With stride > 1 every task is strided, as in pfarm.
+    target_values: (n,) float64, exogenous_block: (n, k) float64
+    returns {window: (shaped_block, inverted_shaped_block)} of dtype
+    '''
+    target_values = np.asarray(target_values, dtype=np.float64)
+    exogenous_block = np.asarray(exogenous_block, dtype=np.float64)
+    n_columns = exogenous_block.shape[1]
+
+    tasks = [(window, column) for window in windows for column in range(n_columns)]
+    if stride > 1:
+        ratios = Parallel(n_jobs=n_jobs)(
+            delayed(_farm_strided)(target_values, exogenous_block[:, column], window, stride, interpolation)
+            for window, column in tasks
+        )
+    else:
+        ratios = Parallel(n_jobs=n_jobs)(
+            delayed(_farm)(target_values, exogenous_block[:, column], window)
+            for window, column in tasks
+        )
+
+    saliencies = {window: np.empty_like(exogenous_block, dtype=dtype) for window in windows}
+    for (window, column), ratio in zip(tasks, ratios):
+        saliencies[window][:, column] = ratio
+    return {window: shape_saliency(saliency, exogenous_block, normalize=False, out=(saliency, np.empty_like(saliency))) for window, saliency in saliencies.items()}
+
 def pfarm(farm_params):
     '''
     FARM SHAPING
@@ -27,29 +507,23 @@ def pfarm(farm_params):
         "df_raw" : df_raw,
         "window" : window,
         "exogenous_feature": feature,
-        "target_feature": target
+        "target_feature": target,
+        "dtype": "float64", # optional, "float32" stores the shaped series in single precision
+        "stride": 1, # optional, run FARM on every stride-th row (lcwin // stride) and interpolate the rest
+        "stride_interpolation": "linear" # optional, "linear" or "step", see strided_saliency
     }
     '''
     df_raw = farm_params["df_raw"]
     window = farm_params["window"]
     exogenous_feature = str(farm_params["exogenous_feature"])
     target_feature = str(farm_params["target_feature"])
-    shaping_ratio = pd.Series(farm(
-        refTS=df_raw[target_feature].values,
-        qryTS=df_raw[str(exogenous_feature)].values,
-        ff_align=False,
-        lcwin=window,
-        fuzzyc=[1]
-    )["rel_local_fuzz"])
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
+    stride, interpolation = saliency_stride(farm_params)
+    if stride > 1:
+        shaping_ratio = _farm_strided(df_raw[target_feature].values, df_raw[exogenous_feature].values, window, stride, interpolation)
+    else:
+        shaping_ratio = _farm(df_raw[target_feature].values, df_raw[str(exogenous_feature)].values, window)
 
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
-
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+    return shape_series(df_raw, exogenous_feature, shaping_ratio, normalize=False, dtype=shaped_dtype(farm_params)), exogenous_feature
 
 def prollcorr(params):
     '''
@@ -58,25 +532,18 @@ def prollcorr(params):
         "df_raw" : df_raw,
         "window" : window,
         "exogenous_feature": feature,
-        "target_feature": target
+        "target_feature": target,
+        "dtype": "float64" # optional, "float32" stores the shaped series in single precision
     }
     '''
     df_raw = params["df_raw"]
     window = params["window"]
     exogenous_feature = str(params["exogenous_feature"])
     target_feature = str(params["target_feature"])
-    saliency = df_raw[target_feature].rolling(window).corr(df_raw[str(exogenous_feature)])
-    
-    shaping_ratio = (saliency-saliency.min())/(saliency.max() - saliency.min()) # normalizing between 0 and 1
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
-
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
+    # NOTE: the prollcorr_windows and prollcorr_block kernel, so a constant window is NaN (left unshaped) on every path
+    saliency = multi_window_corr(df_raw[target_feature].values, df_raw[exogenous_feature].values, [window])[window]
 
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+    return shape_series(df_raw, exogenous_feature, saliency, dtype=shaped_dtype(params)), exogenous_feature
 
 def prollcov(params):
     '''
@@ -85,25 +552,18 @@ def prollcov(params):
         "df_raw" : df_raw,
         "window" : window,
         "exogenous_feature": feature,
-        "target_feature": target
+        "target_feature": target,
+        "dtype": "float64" # optional, "float32" stores the shaped series in single precision
     }
     '''
     df_raw = params["df_raw"]
     window = params["window"]
     exogenous_feature = str(params["exogenous_feature"])
     target_feature = str(params["target_feature"])
-    saliency = df_raw[target_feature].rolling(window).cov(df_raw[str(exogenous_feature)])
-
-    shaping_ratio = (saliency-saliency.min())/(saliency.max() - saliency.min()) # normalizing between 0 and 1
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
-
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
+    # NOTE: the prollcov_windows and prollcov_block kernel, a constant window has a covariance of exactly 0
+    saliency = multi_window_cov(df_raw[target_feature].values, df_raw[exogenous_feature].values, [window])[window]
 
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
-
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+    return shape_series(df_raw, exogenous_feature, saliency, dtype=shaped_dtype(params)), exogenous_feature
 
 def pentropy(params):
     '''
@@ -112,7 +572,8 @@ def pentropy(params):
         "df_raw" : df_raw,
         "window" : window,
         "exogenous_feature": feature,
-        "target_feature": target
+        "target_feature": target,
+        "dtype": "float64" # optional, "float32" stores the shaped series in single precision
     }
     '''
     df_raw = params["df_raw"]
@@ -123,22 +584,9 @@ def pentropy(params):
     target_values, _ = coalesce_series(df_raw[target_feature].values)
     exogenous_values, _ = coalesce_series(df_raw[exogenous_feature].values)
 
-    target_windows = sliding_window_view(target_values, window_shape=window)
-    exogenous_windows = sliding_window_view(exogenous_values, window_shape=window)
+    result = rolling_relative_entropy(target_values, exogenous_values, window)
 
-    result = np.array([relative_entropy(a, b) for a, b in zip(target_windows, exogenous_windows)])
-    saliency = pd.Series([np.nan]*(window-1) + list(result))
-
-    shaping_ratio = (saliency-saliency.min())/(saliency.max() - saliency.min()) # normalizing between 0 and 1
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
-
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
-
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+    return shape_series(df_raw, exogenous_feature, result, offset=window - 1, dtype=shaped_dtype(params)), exogenous_feature # NOTE: the first full window ends at row window-1
 
 def pmutual_info(params):
     '''
@@ -147,7 +595,8 @@ def pmutual_info(params):
         "df_raw" : df_raw,
         "window" : window,
         "exogenous_feature": feature,
-        "target_feature": target
+        "target_feature": target,
+        "dtype": "float64" # optional, "float32" stores the shaped series in single precision
     }
     '''
     df_raw = params["df_raw"]
@@ -158,22 +607,9 @@ def pmutual_info(params):
     target_values, _ = coalesce_series(df_raw[target_feature].values)
     exogenous_values, _ = coalesce_series(df_raw[exogenous_feature].values)
 
-    target_windows = sliding_window_view(target_values, window_shape=window)
-    exogenous_windows = sliding_window_view(exogenous_values, window_shape=window)
+    result = rolling_mutual_info(target_values, exogenous_values, window)
 
-    result = np.array([mutual_info(a, b) for a, b in zip(target_windows, exogenous_windows)])
-    saliency = pd.Series([np.nan]*(window-1) + list(result))
-
-    shaping_ratio = (saliency-saliency.min())/(saliency.max() - saliency.min()) # normalizing between 0 and 1
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
-
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
-
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+    return shape_series(df_raw, exogenous_feature, result, offset=window - 1, dtype=shaped_dtype(params)), exogenous_feature # NOTE: the first full window ends at row window-1
 
 def pdtw(params):
     '''
@@ -182,7 +618,14 @@ def pdtw(params):
         "df_raw" : df_raw,
         "window" : window,
         "exogenous_feature": feature,
-        "target_feature": target
+        "target_feature": target,
+        "dtype": "float64", # optional, "float32" stores the shaped series in single precision
+        "dtw_band": band, # optional Sakoe-Chiba band in steps, None for unconstrained DTW
+        "dtw_stride": stride, # optional, evaluate every stride-th window and interpolate the rest
+        "stride": stride, # optional, overrides dtw_stride, as for the other strided methods
+        "stride_interpolation": "linear", # optional, "linear" or "step", see strided_saliency
+        "dtw_lower_bound": False, # optional, use the O(n) LB_Keogh bound instead of exact DTW
+        "n_jobs": 1 # optional, processes for the per-window distances
     }
     '''
     df_raw = params["df_raw"]
@@ -193,75 +636,241 @@ def pdtw(params):
     target_values = df_raw[target_feature].values
     exogenous_values = df_raw[exogenous_feature].values
 
-    target_windows = sliding_window_view(target_values, window_shape=window)
-    exogenous_windows = sliding_window_view(exogenous_values, window_shape=window)
+    if params.get("dtw_lower_bound", False):
+        result = rolling_lb_keogh(target_values, exogenous_values, window, band=params.get("dtw_band"))
+    else:
+        result = rolling_dtw(
+            target_values,
+            exogenous_values,
+            window,
+            band=params.get("dtw_band"),
+            stride=params.get("stride", params.get("dtw_stride", 1)),
+            n_jobs=params.get("n_jobs", 1),
+            interpolation=saliency_stride(params)[1]
+        )
+
+    return shape_series(df_raw, exogenous_feature, result, offset=window - 1, dtype=shaped_dtype(params)), exogenous_feature # NOTE: the first full window ends at row window-1
+
+def pdtw_block(target_values, exogenous_block, windows, dtype=np.float64, band=None, stride=1, interpolation="linear", lower_bound=False, n_jobs=1, dataset="", features=None):
+    '''
+    DTW DISTANCE SHAPING OF A WHOLE EXOGENOUS BLOCK
+    Same values as pdtw for every column, the k distances of a window start being one C call (see rolling_dtw).
+    band, stride, interpolation, lower_bound and n_jobs are pdtw's dtw_band, stride, stride_interpolation,
+    dtw_lower_bound and n_jobs.
+    target_values: (n,) float64, exogenous_block: (n, k) float64
+    returns {window: (shaped_block, inverted_shaped_block)} of dtype
+    '''
+    target_values = np.asarray(target_values, dtype=np.float64)
+    exogenous_block = np.asarray(exogenous_block, dtype=np.float64)
+    blocks = {}
+    for window in windows:
+        if lower_bound:
+            saliency = np.column_stack([rolling_lb_keogh(target_values, column, window, band=band) for column in exogenous_block.T])
+        else:
+            saliency = rolling_dtw(target_values, exogenous_block, window, band=band, stride=stride, n_jobs=n_jobs, interpolation=interpolation)
+        # NOTE: sliding window results start at the first full window
+        blocks[window] = shape_saliency(saliency, exogenous_block, offset=window - 1, dtype=dtype)
+    return blocks
+
+NOISE_SEED = 42
+
+def noise_generator(dataset_name, feature, window, seed=NOISE_SEED):
+    '''
+    Random generator of the noise baseline of one (dataset, window, feature) task: the child SeedSequence
+    that spawn would give, keyed by a digest of the dataset and feature names and the window instead of a spawn counter,
+    so the draw is the same whatever the task order, batching or number of workers, and does not depend on the values:
+    features with equal values get independent noise, and editing a column keeps its draw.
+    '''
+    digest = hashlib.blake2b("\0".join((str(dataset_name), str(feature))).encode(), digest_size=16).digest()
+    spawn_key = tuple(int.from_bytes(digest[i:i + 4], "little") for i in range(0, 16, 4)) + (int(window),)
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=spawn_key)))
+
+def noise_saliency(exogenous_block, features, windows, skews=(0,), seed=NOISE_SEED, dataset_name=""):
+    '''
+    Rolling mean of full-length skew-normal noise for every column of exogenous_block (named features), window and skew.
+    Each (column, window) draws two standard normal series u0, v once from its noise_generator and every
+    skew level derives from them (delta*|u0| + sqrt(1 - delta^2)*v, delta = skew/sqrt(1 + skew^2), as
+    scipy's skewnorm), then all columns and skews of a window share one rolling-mean pass over the block.
+    Returns {window: {skew: (n - window + 1, k) block}}
+    '''
+    exogenous_block = np.asarray(exogenous_block, dtype=np.float64)
+    exogenous_block = exogenous_block.reshape(exogenous_block.shape[0], -1)
+    n, n_columns = exogenous_block.shape
+    if features is None or len(features) != n_columns:
+        raise ValueError(f"Noise needs one feature name per column, got {features} for {n_columns} columns")
+    delta = np.asarray(skews, dtype=np.float64) / np.sqrt(1 + np.asarray(skews, dtype=np.float64) ** 2)
+    results = {}
+    for window in windows:
+        if window > n:
+            raise ValueError("window shape cannot be larger than input array shape")
+        noise = np.empty((n, len(skews), n_columns))
+        for column, feature in enumerate(features):
+            u0, v = noise_generator(dataset_name, feature, window, seed).standard_normal((2, n))
+            noise[:, :, column] = np.outer(np.abs(u0), delta) + np.outer(v, np.sqrt(1 - delta ** 2))
+        prefix = np.concatenate((np.zeros((1, len(skews) * n_columns)), np.cumsum(noise.reshape(n, -1), axis=0)))
+        means = ((prefix[window:] - prefix[:-window]) / window).reshape(n - window + 1, len(skews), n_columns)
+        results[window] = {skew: means[:, s, :] for s, skew in enumerate(skews)}
+    return results
+
+def pnoise_block(target_values, exogenous_block, windows, dtype=np.float64, skew=0, seed=NOISE_SEED, dataset="", features=None):
+    '''
+    NOISE SHAPING OF A WHOLE EXOGENOUS BLOCK
+    Same values as pnoise for every column, with one rolling-mean pass per window.
+    The draw is keyed by dataset and the column names features, see noise_generator.
+    target_values: (n,) float64 (unused), exogenous_block: (n, k) float64
+    returns {window: (shaped_block, inverted_shaped_block)} of dtype
+    '''
+    exogenous_block = np.asarray(exogenous_block, dtype=np.float64)
+    saliencies = noise_saliency(exogenous_block, features, windows, [skew], seed, dataset)
+    # NOTE: sliding window results start at the first full window
+    return {window: shape_saliency(saliencies[window][skew], exogenous_block, offset=window - 1, dtype=dtype) for window in windows}
 
-    dtw_dists = []
-    for a, b in zip(target_windows, exogenous_windows):
-        a = np.array(a, dtype=np.double)
-        b = np.array(b, dtype=np.double)
-        dtw_dist = dtw.distance_fast(a, b, use_pruning=True)
-        dtw_dists += [dtw_dist]
+def pnoiseskew10_block(target_values, exogenous_block, windows, dtype=np.float64, dataset="", features=None):
+    return pnoise_block(target_values, exogenous_block, windows, dtype=dtype, skew=10, dataset=dataset, features=features)
 
-    result = np.array(dtw_dists)
-    
-    saliency = pd.Series([np.nan]*(window-1) + list(result))
+def pnoise(params, skew=0):
+    '''
+    NOISE BASELINE SHAPING
+    The saliency is the rolling mean of skew-normal noise, see noise_saliency
+    params = {
+        "df_raw" : df_raw,
+        "window" : window,
+        "exogenous_feature": feature,
+        "target_feature": target,
+        "dataset_name": dataset_name, # optional, keys the draw with the feature name, see noise_generator
+        "dtype": "float64", # optional, "float32" stores the shaped series in single precision
+        "noise_seed": 42 # optional base seed of the per-task streams, see noise_generator
+    }
+    '''
+    df_raw = params["df_raw"]
+    window = params["window"]
+    exogenous_feature = str(params["exogenous_feature"])
 
-    shaping_ratio = (saliency-saliency.min())/(saliency.max() - saliency.min()) # normalizing between 0 and 1
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
+    saliency = noise_saliency(
+        df_raw[exogenous_feature].values, [exogenous_feature], [window], [skew], params.get("noise_seed", NOISE_SEED), params.get("dataset_name", "")
+    )[window][skew][:, 0]
 
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
+    return shape_series(df_raw, exogenous_feature, saliency, offset=window - 1, dtype=shaped_dtype(params)), exogenous_feature # NOTE: the first full window ends at row window-1
 
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
+def pnoiseskew10(params):
+    return pnoise(params, skew=10)
 
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+def _shape_windows(df_raw, exogenous_feature, saliencies, offsets=None, dtype=np.float64, dataset="", method=""):
+    '''
+    shape_series for every {window: saliency}, saliency starting at offsets[window] (0 by default)
+    dataset and method only tag the telemetry spans
+    '''
+    shaped = {}
+    for window, saliency in saliencies.items():
+        with span("normalize", dataset=dataset, method=method, feature=exogenous_feature, window=window):
+            shaped[window] = shape_series(df_raw, exogenous_feature, saliency, offset=(offsets or {}).get(window, 0), dtype=dtype)
+    return shaped
 
-def pnoise(params, skew=0):
+def prollcorr_windows(params):
     '''
-    CORRELATION SHAPING
+    CORRELATION SHAPING FOR SEVERAL WINDOWS IN ONE PASS
     params = {
         "df_raw" : df_raw,
-        "window" : window,
+        "windows" : windows,
         "exogenous_feature": feature,
         "target_feature": target
     }
+    returns ({window: {"shaped", "inverted_shaped"}}, exogenous_feature)
     '''
-
-    seed_value = 42
-    np.random.seed(seed_value)
-
     df_raw = params["df_raw"]
-    window = params["window"]
     exogenous_feature = str(params["exogenous_feature"])
     target_feature = str(params["target_feature"])
+    saliencies = multi_window_corr(df_raw[target_feature].values, df_raw[exogenous_feature].values, params["windows"])
+    return _shape_windows(df_raw, exogenous_feature, saliencies, dtype=shaped_dtype(params), dataset=params.get("dataset_name", ""), method="prollcorr"), exogenous_feature
 
-    from scipy.stats import skewnorm
-
-    # Define parameters for the skew-normal distribution
-    skew = 0  # Skewness parameter (positive for right skew, negative for left skew)
-    loc = 0  # Location parameter (mean)
-    scale = 1  # Scale parameter (standard deviation)
-    series_size = len(target_feature)  # Number of samples
+def prollcov_windows(params):
+    '''
+    COVARIANCE SHAPING FOR SEVERAL WINDOWS IN ONE PASS
+    params = {
+        "df_raw" : df_raw,
+        "windows" : windows,
+        "exogenous_feature": feature,
+        "target_feature": target
+    }
+    returns ({window: {"shaped", "inverted_shaped"}}, exogenous_feature)
+    '''
+    df_raw = params["df_raw"]
+    exogenous_feature = str(params["exogenous_feature"])
+    target_feature = str(params["target_feature"])
+    saliencies = multi_window_cov(df_raw[target_feature].values, df_raw[exogenous_feature].values, params["windows"])
+    return _shape_windows(df_raw, exogenous_feature, saliencies, dtype=shaped_dtype(params), dataset=params.get("dataset_name", ""), method="prollcov"), exogenous_feature
 
-    # Generate random samples from a skew-normal distribution
-    skew_normal_noise = skewnorm.rvs(skew, loc=loc, scale=scale, size=series_size)
+def pentropy_windows(params):
+    '''
+    RELATIVE ENTROPY SHAPING FOR SEVERAL WINDOWS IN ONE PASS
+    params = {
+        "df_raw" : df_raw,
+        "windows" : windows,
+        "exogenous_feature": feature,
+        "target_feature": target
+    }
+    returns ({window: {"shaped", "inverted_shaped"}}, exogenous_feature)
+    '''
+    df_raw = params["df_raw"]
+    exogenous_feature = str(params["exogenous_feature"])
+    target_feature = str(params["target_feature"])
 
-    # Create a Pandas Series from the generated noise
-    skew_noise_series = pd.Series(skew_normal_noise)
-    saliency = pd.Series(skew_noise_series).rolling(window).mean()
-    shaping_ratio = (saliency-saliency.min())/(saliency.max() - saliency.min()) # normalizing between 0 and 1
+    target_values, _ = coalesce_series(df_raw[target_feature].values)
+    exogenous_values, _ = coalesce_series(df_raw[exogenous_feature].values)
 
-    shaping_ratio_inverted = (shaping_ratio - 1).abs() # NOTE: INVERTING
+    saliencies = multi_window_relative_entropy(target_values, exogenous_values, params["windows"])
+    offsets = {window: window - 1 for window in saliencies} # NOTE: sliding window results start at the first full window
+    return _shape_windows(df_raw, exogenous_feature, saliencies, offsets, dtype=shaped_dtype(params), dataset=params.get("dataset_name", ""), method="pentropy"), exogenous_feature
 
-    shaping_ratio = shaping_ratio.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
-    shaping_ratio_inverted = shaping_ratio_inverted.fillna(1) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
+def pmutual_info_windows(params):
+    '''
+    MUTUAL INFORMATION SHAPING FOR SEVERAL WINDOWS IN ONE PASS
+    params = {
+        "df_raw" : df_raw,
+        "windows" : windows,
+        "exogenous_feature": feature,
+        "target_feature": target
+    }
+    returns ({window: {"shaped", "inverted_shaped"}}, exogenous_feature)
+    '''
+    df_raw = params["df_raw"]
+    exogenous_feature = str(params["exogenous_feature"])
+    target_feature = str(params["target_feature"])
 
-    ret = df_raw[str(exogenous_feature)] * shaping_ratio
-    ret_inverted = df_raw[str(exogenous_feature)] * shaping_ratio_inverted
+    target_values, _ = coalesce_series(df_raw[target_feature].values)
+    exogenous_values, _ = coalesce_series(df_raw[exogenous_feature].values)
 
-    return {"shaped" : ret, "inverted_shaped": ret_inverted}, exogenous_feature
+    saliencies = multi_window_mutual_info(target_values, exogenous_values, params["windows"])
+    offsets = {window: window - 1 for window in saliencies} # NOTE: sliding window results start at the first full window
+    return _shape_windows(df_raw, exogenous_feature, saliencies, offsets, dtype=shaped_dtype(params), dataset=params.get("dataset_name", ""), method="pmutual_info"), exogenous_feature
+
+BLOCK_COLUMNS = 256 # NOTE: columns per prefix-sum pass, bounds memory on wide datasets
+
+def _block_process(multi_window_fn, target_values, exogenous_block, windows, dtype=np.float64, dataset="", method=""):
+    exogenous_block = np.asarray(exogenous_block, dtype=np.float64)
+    target_values = np.asarray(target_values, dtype=np.float64)
+    blocks = {window: (np.empty_like(exogenous_block, dtype=dtype), np.empty_like(exogenous_block, dtype=dtype)) for window in windows}
+    for start in range(0, exogenous_block.shape[1], BLOCK_COLUMNS):
+        columns = slice(start, start + BLOCK_COLUMNS)
+        saliencies = multi_window_fn(target_values, exogenous_block[:, columns], windows)
+        for window, saliency_block in saliencies.items():
+            with span("normalize", dataset=dataset, method=method, feature=f"columns {start}:{start + saliency_block.shape[1]}", window=window):
+                # NOTE: written straight into the column slice of the result blocks
+                shape_saliency(saliency_block, exogenous_block[:, columns], out=(blocks[window][0][:, columns], blocks[window][1][:, columns]))
+    return blocks
+
+def prollcorr_block(target_values, exogenous_block, windows, dtype=np.float64, dataset="", features=None):
+    '''
+    CORRELATION SHAPING OF A WHOLE EXOGENOUS BLOCK
+    target_values: (n,) float64, exogenous_block: (n, k) float64
+    returns {window: (shaped_block, inverted_shaped_block)} of dtype
+    '''
+    return _block_process(multi_window_corr, target_values, exogenous_block, windows, dtype, dataset, "prollcorr")
 
-def pnoiseskew10(params):
-    return pnoise(params, skew=10)
\ No newline at end of file
+def prollcov_block(target_values, exogenous_block, windows, dtype=np.float64, dataset="", features=None):
+    '''
+    COVARIANCE SHAPING OF A WHOLE EXOGENOUS BLOCK
+    target_values: (n,) float64, exogenous_block: (n, k) float64
+    returns {window: (shaped_block, inverted_shaped_block)} of dtype
+    '''
+    return _block_process(multi_window_cov, target_values, exogenous_block, windows, dtype, dataset, "prollcov")
@@ -0,0 +1,194 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from datasetsforecast.long_horizon2 import LongHorizon2
+
+from datasets_metadata import ts_metadata
+from telemetry import span
+
+WIDE_CACHE_PATH = "./raw/long_horizon2" # NOTE: None disables the wide cache
+RAW_CACHE_PATH = "./raw/.cache" # NOTE: None disables the load_dataset cache
+NPY = ".npy"
+ARROW = ".arrow"
+
+
+def pivot_long_frame(Y_df, target_ts):
+    '''
+    Turns a long (unique_id, ds, y) frame wide in one pass: the y values are gathered in
+    (unique_id, ds) order straight into one preallocated (n_series, n_rows) float64 array,
+    so the wide frame is a single block instead of one column insertion per series.
+    Returns ds, the target series as y and every other series as a column named by its unique_id.
+    Raises ValueError if the series do not all have the same length and timestamps as the target.
+    '''
+    codes, unique_ids = pd.factorize(Y_df["unique_id"], sort=True)
+    if target_ts not in unique_ids:
+        raise ValueError(f"Target series {target_ts} not found in unique_id")
+    n_series = len(unique_ids)
+    lengths = np.bincount(codes, minlength=n_series)
+    target_code = unique_ids.get_loc(target_ts)
+    n_rows = lengths[target_code]
+    if (lengths != n_rows).any():
+        wrong = {str(unique_ids[code]): int(lengths[code]) for code in np.flatnonzero(lengths != n_rows)}
+        raise ValueError(f"Series lengths differ from the {n_rows} rows of {target_ts}: {wrong}")
+
+    # NOTE: only the distinct timestamps are parsed, rows are ordered by their rank
+    ds_codes, unique_ds = pd.factorize(Y_df["ds"])
+    unique_ds = pd.to_datetime(unique_ds).to_numpy()
+    ds_rank = np.empty(len(unique_ds), dtype=np.int64)
+    ds_rank[np.argsort(unique_ds, kind="stable")] = np.arange(len(unique_ds))
+    ds_rank = ds_rank[ds_codes]
+    order = np.argsort(codes * np.int64(len(unique_ds)) + ds_rank, kind="stable")
+
+    ds_rank = ds_rank[order].reshape(n_series, n_rows)
+    misaligned = np.flatnonzero((ds_rank != ds_rank[target_code]).any(axis=1))
+    if misaligned.size:
+        raise ValueError(f"Series timestamps differ from {target_ts}: {[str(unique_ids[code]) for code in misaligned]}")
+    ds = unique_ds[ds_codes[order[target_code * n_rows:(target_code + 1) * n_rows]]]
+
+    values = np.empty((n_series, n_rows), dtype=np.float64)
+    np.take(Y_df["y"].to_numpy(dtype=np.float64), order, out=values.reshape(-1))
+
+    exogenous_codes = [code for code in range(n_series) if code != target_code]
+    head = pd.DataFrame({
+        "ds": ds,
+        "unique_id": f"{target_ts}_raw",
+        "y": values[target_code]
+    })
+    # NOTE: transposed view of the C-ordered values, pandas keeps it as one block without copying
+    exogenous = pd.DataFrame(values[exogenous_codes].T, columns=[str(unique_ids[code]) for code in exogenous_codes])
+    return pd.concat([head, exogenous], axis=1)
+
+
+def load_long_horizon(dataset_name, directory="data", cache_directory=WIDE_CACHE_PATH, refresh=False):
+    '''
+    Wide df_raw of a LongHorizon2 dataset, as the nixtla driver shapes it.
+    The first call loads the long format and pivots it with pivot_long_frame; the wide result
+    is stored as {cache_directory}/{dataset_name}.parquet and later calls read only that file.
+    '''
+    cache_path = os.path.join(cache_directory, f"{dataset_name}.parquet") if cache_directory else None
+    if cache_path and not refresh and os.path.exists(cache_path):
+        with span("load", dataset=dataset_name, source=cache_path):
+            return pd.read_parquet(cache_path)
+
+    with span("load", dataset=dataset_name, source="LongHorizon2"):
+        Y_df = LongHorizon2.load(directory=directory, group=dataset_name)
+        Y_df.columns = [str(col) for col in Y_df.columns]
+    with span("pivot", dataset=dataset_name):
+        df_raw = pivot_long_frame(Y_df, ts_metadata[dataset_name]["target_ts"])
+
+    if cache_path:
+        os.makedirs(cache_directory, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        df_raw.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path) # NOTE: never leave a partial cache file behind
+    return df_raw
+
+
+def _source_path(relative_path):
+    # NOTE: Parquet is faster to read than the CSV the metadata points at, when both exist
+    stem = os.path.splitext(relative_path)[0]
+    for path in (f"{stem}.parquet", f"{stem}.csv", relative_path):
+        if os.path.exists(path):
+            return path
+    return None
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def _read_source(path, dtype):
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, engine="pyarrow")
+    df.columns = [str(col) for col in df.columns]
+    numeric = df.select_dtypes("number").columns
+    return df.astype({column: dtype for column in numeric})
+
+def _write_ipc(table, path):
+    with ipc.new_file(path, table.schema) as writer:
+        writer.write_table(table)
+
+def _read_ipc(path):
+    # NOTE: memory-mapped, numeric columns without nulls come out as zero-copy views
+    table = ipc.open_file(pa.memory_map(path)).read_all()
+    return table.to_pandas(split_blocks=True)
+
+def _arrow_table(df):
+    # NOTE: NaN stays NaN instead of becoming null, nulls would force a copy when reading
+    numeric = set(df.select_dtypes("number").columns)
+    return pa.table({
+        str(column): pa.array(df[column].to_numpy(), from_pandas=False) if column in numeric else pa.array(df[column])
+        for column in df.columns
+    })
+
+def _write_cache(df, prefix, dtype, cache_format, stamp):
+    numeric = [str(column) for column in df.select_dtypes("number").columns]
+    others = [str(column) for column in df.columns if column not in numeric]
+    if cache_format == NPY:
+        # NOTE: column-major so every column is one contiguous run of pages
+        values = np.lib.format.open_memmap(f"{prefix}.npy.tmp", mode="w+", dtype=dtype, shape=(len(df), len(numeric)), fortran_order=True)
+        values[:] = df[numeric].to_numpy()
+        values.flush()
+        del values
+        os.replace(f"{prefix}.npy.tmp", f"{prefix}.npy")
+        _write_ipc(_arrow_table(df[others]), f"{prefix}.arrow.tmp")
+    elif cache_format == ARROW:
+        _write_ipc(_arrow_table(df), f"{prefix}.arrow.tmp")
+    else:
+        raise ValueError(f"Unknown cache format {cache_format}, available: {[NPY, ARROW]}")
+    os.replace(f"{prefix}.arrow.tmp", f"{prefix}.arrow")
+
+    # NOTE: the metadata is written last, an entry without it is incomplete and rebuilt
+    meta = {"format": cache_format, "source": stamp, "columns": [str(column) for column in df.columns], "numeric": numeric}
+    with open(f"{prefix}.json.tmp", "w") as file:
+        json.dump(meta, file)
+    os.replace(f"{prefix}.json.tmp", f"{prefix}.json")
+    return meta
+
+def _read_cache(prefix, meta):
+    if meta["format"] == ARROW:
+        return _read_ipc(f"{prefix}.arrow")
+    # NOTE: copy-on-write mapping, the frame can be modified without touching the cache file
+    values = np.load(f"{prefix}.npy", mmap_mode="c")
+    numeric = pd.DataFrame(values, columns=meta["numeric"], copy=False)
+    others = _read_ipc(f"{prefix}.arrow")
+    return pd.concat([others, numeric], axis=1)[meta["columns"]]
+
+def load_dataset(dataset_name, dtype=np.float64, cache_format=NPY, cache_directory=RAW_CACHE_PATH, refresh=False, metadata=ts_metadata):
+    '''
+    df_raw of a dataset described by metadata, from the fastest representation available:
+    the memory-mapped NPY or Arrow IPC cache, then the Parquet file next to relative_path, then the CSV.
+    Numeric columns are cast to dtype (np.float32 or np.float64). The first load writes the cache
+    ({cache_directory}/{dataset_name}.{dtype}.{npy or arrow}.*), which is rebuilt when the source file changes.
+    Numeric columns read from the cache are views on the mapped file, so nothing is parsed or copied.
+    They are copy-on-write with the NPY cache; with the Arrow cache they are read-only and the frame
+    must be copied before modifying values in place (replacing columns is fine).
+    '''
+    dtype = np.dtype(dtype)
+    if cache_format not in (NPY, ARROW):
+        raise ValueError(f"Unknown cache format {cache_format}, available: {[NPY, ARROW]}")
+    source = _source_path(metadata[dataset_name]["relative_path"])
+    stamp = _source_stamp(source) if source else None
+    # NOTE: one cache per format, a load never serves the other format's entry
+    prefix = os.path.join(cache_directory, f"{dataset_name}.{dtype.name}.{cache_format.lstrip('.')}") if cache_directory else None
+
+    if prefix and not refresh and os.path.exists(f"{prefix}.json"):
+        with open(f"{prefix}.json") as file:
+            meta = json.load(file)
+        if stamp is None or meta["source"] == stamp:
+            with span("load", dataset=dataset_name, source=f"{prefix}{meta['format']}"):
+                return _read_cache(prefix, meta)
+
+    if source is None:
+        raise FileNotFoundError(f"No raw file for {dataset_name} at {metadata[dataset_name]['relative_path']}")
+    with span("load", dataset=dataset_name, source=source):
+        df_raw = _read_source(source, dtype)
+    if not prefix:
+        return df_raw
+    os.makedirs(cache_directory, exist_ok=True)
+    return _read_cache(prefix, _write_cache(df_raw, prefix, dtype, cache_format, stamp))
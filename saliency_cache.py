@@ -0,0 +1,227 @@
+import os
+import types
+import hashlib
+import tempfile
+import functools
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from shaping_methods import METHODS
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__)) # NOTE: functions defined here are hashed into the keys
+
+
+def _code_digest(code, digest):
+    # NOTE: nested code objects (inner functions, lambdas) are hashed by content, their repr holds an address
+    digest.update(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+def _called_functions(code, namespace):
+    for name in code.co_names:
+        value = namespace.get(name)
+        if isinstance(value, types.FunctionType) and os.path.dirname(os.path.abspath(value.__code__.co_filename)) == REPO_DIRECTORY:
+            yield value
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _called_functions(const, namespace)
+
+@functools.lru_cache(maxsize=None)
+def implementation_digest(process_fn):
+    '''
+    Digest of the code that produces the values of process_fn: its bytecode, that of the multi-window
+    and block variants registered for it, and that of every function of this repo they call, recursively
+    (kernels such as _rolling_state_sums, multi_window_corr or shape_saliency).
+    An unregistered process_fn is hashed with its callees only.
+    '''
+    method = METHODS.get(process_fn.__name__, {"process_fn": process_fn})
+    pending = [method.get(key) for key in ("process_fn", "multi_window_fn", "block_fn") if method.get(key) is not None]
+    seen = {}
+    while pending:
+        fn = pending.pop()
+        name = f"{fn.__module__}.{fn.__qualname__}"
+        if name in seen:
+            continue
+        seen[name] = fn
+        pending += list(_called_functions(fn.__code__, fn.__globals__))
+    digest = hashlib.blake2b(digest_size=8)
+    for name in sorted(seen):
+        digest.update(name.encode())
+        _code_digest(seen[name].__code__, digest)
+    return digest.hexdigest()
+
+
+class SaliencyCache:
+    '''
+    Content-addressed on-disk cache of shaped series.
+    An entry is keyed by the bytes of the target and exogenous columns, the shaping function
+    (name and implementation_digest, so editing it, its multi-window or block variant or any kernel they call
+    invalidates its entries), the window and any extra method options in the params (e.g. the DTW band, or the
+    dataset and feature names of the methods registered name_keyed), and
+    holds the shaped and inverted series as one (2, n) array of dtype, returned as stored. Entries are evicted least
+    recently used first once the cache grows past max_bytes, from an in-memory LRU index built once from the
+    file mtimes, so a write never walks the cache directory.
+    '''
+    def __init__(self, directory, max_bytes=20 * 1024**3, dtype=np.float64):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index = OrderedDict() # NOTE: path -> size, least recently used first
+        for path, _, size in sorted(self._entries(), key=lambda entry: entry[1]):
+            self._index[path] = size
+        self._size = sum(self._index.values())
+
+    def _entries(self):
+        for subdir, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith(".npy"):
+                    stat = os.stat(os.path.join(subdir, file))
+                    yield os.path.join(subdir, file), stat.st_mtime, stat.st_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+    @staticmethod
+    def column_digest(values):
+        return hashlib.blake2b(np.ascontiguousarray(values, dtype=np.float64).tobytes(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def function_digest(process_fn):
+        return implementation_digest(process_fn)
+
+    def key(self, process_fn, target_digest, exogenous_digest, window, options=None):
+        options = sorted((options or {}).items()) # NOTE: method settings such as the DTW band change the result
+        key = f"{process_fn.__module__}.{process_fn.__qualname__}|{self.function_digest(process_fn)}|{target_digest}|{exogenous_digest}|{window}|{options}"
+        return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+    def get(self, key, index):
+        path = self._path(key)
+        try:
+            values = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        os.utime(path) # NOTE: LRU order across runs is file mtime
+        if path in self._index:
+            self._index.move_to_end(path)
+        self.hits += 1
+        return {
+            "shaped": pd.Series(values[0], index=index),
+            "inverted_shaped": pd.Series(values[1], index=index)
+        }
+
+    def put(self, key, agg_qts_shaped):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        values = np.stack([
+            np.asarray(agg_qts_shaped["shaped"], dtype=self.dtype),
+            np.asarray(agg_qts_shaped["inverted_shaped"], dtype=self.dtype)
+        ])
+        # NOTE: write then rename, so a crash never leaves a truncated entry behind
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as tmp:
+            np.save(tmp, values)
+        os.replace(tmp.name, path)
+        self._size += os.path.getsize(path) - self._index.pop(path, 0)
+        self._index[path] = os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        while self._size > self.max_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue # NOTE: removed by another process sharing the directory
+            self.evictions += 1
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0
+        return f"Saliency cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {self.evictions} evictions, {self._size / 1024**2:.1f} MiB"
+
+
+def cache_lookup(cache, process_fn, params_list):
+    '''
+    Serves process_windows-style params from the cache.
+    Returns (results, missing, keys): results in the [({window: {"shaped", "inverted_shaped"}}, exogenous_feature)]
+    format holding the cached windows, missing as {missing_windows: [index in params_list]} and the
+    per-window cache keys to pass to cache_store. Without a cache everything is missing.
+    '''
+    if cache is None:
+        results = [({}, str(params["exogenous_feature"])) for params in params_list]
+        missing = {}
+        for i, params in enumerate(params_list):
+            missing.setdefault(tuple(params["windows"]), []).append(i)
+        return results, missing, None
+
+    column_digests = {}
+    def digest(df_raw, column):
+        if column not in column_digests:
+            column_digests[column] = cache.column_digest(df_raw[column].values)
+        return column_digests[column]
+
+    results = []
+    missing = {}
+    keys = []
+    for i, params in enumerate(params_list):
+        df_raw = params["df_raw"]
+        exogenous_feature = str(params["exogenous_feature"])
+        target_digest = digest(df_raw, str(params["target_feature"]))
+        exogenous_digest = digest(df_raw, exogenous_feature)
+        options = {key: value for key, value in params.items() if key not in ("df_raw", "windows", "target_feature", "exogenous_feature", "dataset_name")}
+        if METHODS[process_fn.__name__]["name_keyed"]:
+            # NOTE: e.g. the noise draw, keyed by the names so equal columns do not share an entry
+            options.update(dataset_name=params.get("dataset_name", ""), exogenous_feature=exogenous_feature)
+
+        windows_shaped = {}
+        keys += [{}]
+        for window in params["windows"]:
+            keys[i][window] = cache.key(process_fn, target_digest, exogenous_digest, window, options)
+            agg_qts_shaped = cache.get(keys[i][window], df_raw.index)
+            if agg_qts_shaped is not None:
+                windows_shaped[window] = agg_qts_shaped
+        results += [(windows_shaped, exogenous_feature)]
+
+        missing_windows = tuple(window for window in params["windows"] if window not in windows_shaped)
+        if missing_windows:
+            missing.setdefault(missing_windows, []).append(i)
+
+    return results, missing, keys
+
+def cache_store(cache, keys, results, i, windows_shaped):
+    '''
+    Merges freshly computed windows of params_list[i] into results and stores them in the cache
+    '''
+    for window, agg_qts_shaped in windows_shaped.items():
+        if cache is not None:
+            cache.put(keys[i][window], agg_qts_shaped)
+        results[i][0][window] = agg_qts_shaped
+
+def process_cached(cache, process_fn, params_list, compute):
+    '''
+    Serves process_windows-style params from the cache and computes only the missing windows.
+    compute(process_fn, params_list) must return [({window: {"shaped", "inverted_shaped"}}, exogenous_feature)]
+    in the order of params_list; it is called once per distinct set of missing windows.
+    Returns the results for params_list in the same format.
+    '''
+    if cache is None:
+        return compute(process_fn, params_list)
+
+    results, missing, keys = cache_lookup(cache, process_fn, params_list)
+    for missing_windows, indices in missing.items():
+        missing_params = [dict(params_list[i], windows=list(missing_windows)) for i in indices]
+        for i, (windows_shaped, _) in zip(indices, compute(process_fn, missing_params)):
+            cache_store(cache, keys, results, i, windows_shaped)
+
+    return results
@@ -0,0 +1,103 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from datasets_metadata import ts_metadata
+from preprocessing_utilities import assemble_shaped
+from shaping_methods import METHODS, get_method, backend, process_windows, process_block, block_options
+from saliency_cache import process_cached
+from shared_frame import shared_frame
+from raw_loader import load_dataset
+
+
+class ShapedDataset:
+    '''
+    Lazy view over every (dataset, window, method, inverted) variant described by ts_metadata.
+    Nothing is computed up front: indexing computes only the requested variant and keeps the
+    max_variants most recently used frames in memory, so memory follows the variants actually used.
+
+    shaped = ShapedDataset()
+    df = shaped["ETTh1", 501, "prollcorr", False]
+    for key, df in shaped.stream(shaped.variants(datasets=["ETTh1"], methods=["pentropy"])):
+        ...
+    '''
+    def __init__(self, metadata=ts_metadata, loader=load_dataset, cache=None, max_variants=4, n_jobs=-1, dtype=np.float64):
+        self.metadata = metadata
+        self.loader = loader
+        self.cache = cache # NOTE: optional SaliencyCache shared with the drivers
+        self.max_variants = max_variants
+        self.n_jobs = n_jobs
+        self.dtype = np.dtype(dtype).name # NOTE: dtype of the shaped columns, see shaped_dtype
+        self._raw = {}
+        self._variants = OrderedDict()
+
+    def raw(self, dataset_name):
+        if dataset_name not in self._raw:
+            self._raw[dataset_name] = self.loader(dataset_name)
+        return self._raw[dataset_name]
+
+    def variants(self, datasets=None, windows=None, methods=None, inverted=(False, True)):
+        '''
+        Yields the (dataset, window, method, inverted) keys of the requested slice of the grid
+        '''
+        methods = methods or list(METHODS)
+        for dataset_name in datasets or list(self.metadata):
+            dataset_windows = windows or self.metadata[dataset_name]["farm_windows"]
+            yield from itertools.product([dataset_name], dataset_windows, methods, inverted)
+
+    def __getitem__(self, key):
+        dataset_name, window, method, inverted = key
+        if key in self._variants:
+            self._variants.move_to_end(key)
+            return self._variants[key]
+
+        shaped, shaped_inverted = self._compute(dataset_name, window, method)
+        self._remember((dataset_name, window, method, False), shaped)
+        self._remember((dataset_name, window, method, True), shaped_inverted)
+        return shaped_inverted if inverted else shaped
+
+    def stream(self, keys):
+        '''
+        Yields (key, df) one variant at a time without keeping them beyond the LRU
+        '''
+        for key in keys:
+            yield key, self[key]
+
+    def _remember(self, key, df):
+        if self.max_variants <= 0:
+            return
+        self._variants[key] = df
+        self._variants.move_to_end(key)
+        while len(self._variants) > self.max_variants:
+            self._variants.popitem(last=False)
+
+    def _compute_features(self, process_fn, params_list):
+        if get_method(process_fn)["batch_columns"]: # NOTE: same dispatch as the grid scheduler
+            params = params_list[0]
+            features = [param["exogenous_feature"] for param in params_list]
+            return process_block(process_fn, params["df_raw"], params["target_feature"], features, params["windows"], **block_options(process_fn, params))
+        return Parallel(n_jobs=self.n_jobs, backend=backend([process_fn]))(delayed(process_windows)(process_fn, param) for param in params_list)
+
+    def _compute(self, dataset_name, window, method):
+        process_fn = get_method(method)["process_fn"]
+        df_raw = self.raw(dataset_name)
+        target_ts = str(self.metadata[dataset_name]["target_ts"])
+        with shared_frame(df_raw) as shared_raw:
+            params_list = [
+                {
+                    "df_raw": shared_raw,
+                    "windows": [window],
+                    "target_feature": target_ts,
+                    "exogenous_feature": feature,
+                    "dataset_name": dataset_name,
+                    "dtype": self.dtype
+                }
+                for feature in self.metadata[dataset_name]["exog_list"]
+                if str(feature) != target_ts
+            ]
+            results_processed = process_cached(self.cache, process_fn, params_list, self._compute_features)
+
+        # NOTE: both variants share the raw columns of the cached df_raw, as the drivers' frames do
+        return [assemble_shaped(df_raw, results_processed, window, inverted=inverted, target_feature=target_ts) for inverted in (False, True)]
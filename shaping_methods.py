@@ -0,0 +1,202 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from preprocessing_utilities import pfarm, prollcorr, prollcov, pentropy, pmutual_info, pdtw, pnoise, pnoiseskew10
+from preprocessing_utilities import prollcorr_windows, prollcov_windows, pentropy_windows, pmutual_info_windows
+from preprocessing_utilities import pfarm_block, prollcorr_block, prollcov_block, pdtw_block, pnoise_block, pnoiseskew10_block
+from preprocessing_utilities import saliency_stride, shaped_dtype
+from streaming_shaper import STREAMING_SALIENCY
+from chunked_shaper import CHUNKED_SALIENCY
+from telemetry import span
+
+METHODS = {} # NOTE: name -> method entry, see register_method
+
+
+def register_method(process_fn, cost, multi_window_fn=None, block_fn=None, batch_columns=False, block_params=None, name_keyed=False, thread_safe=False, strided=False, streaming=None, chunked=None):
+    '''
+    Declares a shaping method, so the drivers, the scheduler and the benchmark pick it up by name.
+    process_fn(params) -> ({"shaped", "inverted_shaped"}, exogenous_feature), as every p* function
+    cost(n, window, params): relative cost of one feature and one window of n rows, only the ordering matters
+    multi_window_fn(params): all params["windows"] in one pass, see process_windows
+    block_fn(target_values, exogenous_block, windows, dtype, dataset, features): all columns in one call, see process_block
+    batch_columns: block_fn is a single vectorized pass, worth one task for every column of a job
+    block_params(params): block_fn's own keyword arguments from process_windows-style params, see block_options
+    name_keyed: the result depends on the dataset and feature names, not only on the values, so the saliency cache keys them
+    thread_safe: no global state and the heavy work releases the GIL, so threads can replace processes
+    strided: honours params["stride"], see strided_saliency
+    streaming: StreamingShaper supports it, by default when STREAMING_SALIENCY has the method
+    chunked: shape_parquet supports it, by default when CHUNKED_SALIENCY has the method
+    '''
+    name = process_fn.__name__
+    METHODS[name] = {
+        "name": name,
+        "process_fn": process_fn,
+        "cost": cost,
+        "multi_window_fn": multi_window_fn,
+        "block_fn": block_fn,
+        "batch_columns": batch_columns and block_fn is not None,
+        "block_params": block_params,
+        "name_keyed": name_keyed,
+        "thread_safe": thread_safe,
+        "strided": strided,
+        "streaming": name in STREAMING_SALIENCY if streaming is None else streaming,
+        "chunked": name in CHUNKED_SALIENCY if chunked is None else chunked,
+    }
+    return METHODS[name]
+
+def get_method(method):
+    '''
+    Registry entry of a method given by name or process_fn
+    '''
+    name = method if isinstance(method, str) else method.__name__
+    if name not in METHODS:
+        raise ValueError(f"Unknown shaping method {name}, available: {list(METHODS)}")
+    return METHODS[name]
+
+def methods_with(**capabilities):
+    '''
+    Names of the registered methods having every given capability, e.g. methods_with(strided=True)
+    '''
+    return [name for name, entry in METHODS.items() if all(bool(entry[key]) == value for key, value in capabilities.items())]
+
+def estimate_cost(process_fn, params_list):
+    cost = get_method(process_fn)["cost"]
+    return sum(
+        cost(len(params["df_raw"]), window, params)
+        for params in params_list
+        for window in params["windows"]
+    )
+
+def backend(process_fns):
+    '''
+    joblib backend for running these methods together: threads when all of them are thread safe
+    (no pickling, no worker start-up), processes otherwise
+    '''
+    return "threading" if all(get_method(process_fn)["thread_safe"] for process_fn in process_fns) else "loky"
+
+def process_windows(process_fn, params):
+    '''
+    Runs process_fn for every window in params["windows"], in a single pass when the method has a
+    multi-window variant and one window at a time otherwise.
+    returns ({window: {"shaped", "inverted_shaped"}}, exogenous_feature)
+    params["dataset_name"], when given, tags the telemetry spans.
+    '''
+    exogenous_feature = str(params["exogenous_feature"])
+    dataset = params.get("dataset_name", "")
+    multi_window_fn = get_method(process_fn)["multi_window_fn"]
+    if multi_window_fn is not None:
+        with span("saliency", dataset=dataset, method=process_fn.__name__, feature=exogenous_feature, window=",".join(str(window) for window in params["windows"])):
+            return multi_window_fn(params)
+
+    results = {}
+    for window in params["windows"]:
+        window_params = {key: value for key, value in params.items() if key != "windows"}
+        window_params["window"] = window
+        with span("saliency", dataset=dataset, method=process_fn.__name__, feature=exogenous_feature, window=window):
+            results[window], _ = process_fn(window_params)
+    return results, exogenous_feature
+
+def block_options(process_fn, params):
+    '''
+    process_block keyword arguments giving the same values as process_windows(process_fn, params):
+    the dtype, the dataset tag, the stride of strided methods and the method's block_params
+    '''
+    method = get_method(process_fn)
+    options = {"dtype": shaped_dtype(params), "dataset": params.get("dataset_name", "")}
+    if method["strided"]:
+        options["stride"], options["interpolation"] = saliency_stride(params)
+    if method["block_params"] is not None:
+        options.update(method["block_params"](params))
+    return options
+
+def process_block(process_fn, df_raw, target_feature, exogenous_features, windows, dtype=np.float64, stride=1, interpolation="linear", dataset="", **options):
+    '''
+    Shapes every exogenous feature for every window with one call of the method's block_fn,
+    returning the same [({window: {"shaped", "inverted_shaped"}}, exogenous_feature)] list
+    as mapping process_windows over the features. stride is ignored by the exact methods.
+    options are passed on to block_fn, see block_options. dataset tags the telemetry spans and, with the
+    feature names, keys the draw of the noise methods.
+    '''
+    method = get_method(process_fn)
+    if method["block_fn"] is None:
+        raise ValueError(f"{method['name']} has no block variant, available: {methods_with(block_fn=True)}")
+    exogenous_features = [str(feature) for feature in exogenous_features]
+    if method["strided"] and stride > 1:
+        options = dict(options, stride=stride, interpolation=interpolation)
+    with span("saliency", dataset=dataset, method=process_fn.__name__, feature=f"{len(exogenous_features)} features", window=",".join(str(window) for window in windows)):
+        blocks = method["block_fn"](
+            df_raw[str(target_feature)].values,
+            df_raw[exogenous_features].to_numpy(dtype=np.float64),
+            windows,
+            dtype=np.dtype(dtype),
+            dataset=dataset,
+            features=exogenous_features,
+            **options
+        )
+
+    results = []
+    for i, feature in enumerate(exogenous_features):
+        windows_shaped = {}
+        for window, (shaped_block, inverted_block) in blocks.items():
+            windows_shaped[window] = {
+                "shaped": pd.Series(shaped_block[:, i], index=df_raw.index, name=feature),
+                "inverted_shaped": pd.Series(inverted_block[:, i], index=df_raw.index, name=feature)
+            }
+        results += [(windows_shaped, feature)]
+    return results
+
+def _stride(params):
+    return params.get("stride", 1)
+
+# NOTE: built-in methods, costs are relative to one O(n log n) pass
+register_method(
+    pfarm,
+    cost=lambda n, window, params: n * window / _stride(params) ** 2,
+    block_fn=pfarm_block, # NOTE: for direct calls only; not batch_columns, so the drivers, ShapedDataset and the benchmark all run one pfarm task per feature
+    strided=True
+)
+register_method(
+    prollcorr,
+    cost=lambda n, window, params: 0.01 * n,
+    multi_window_fn=prollcorr_windows,
+    block_fn=prollcorr_block,
+    batch_columns=True,
+    thread_safe=True
+)
+register_method(
+    prollcov,
+    cost=lambda n, window, params: 0.01 * n,
+    multi_window_fn=prollcov_windows,
+    block_fn=prollcov_block,
+    batch_columns=True,
+    thread_safe=True
+)
+register_method(
+    pentropy,
+    cost=lambda n, window, params: n * math.log2(n),
+    multi_window_fn=pentropy_windows # NOTE: not strided, the exact rolling pass is already O(n log n)
+)
+register_method(
+    pmutual_info,
+    cost=lambda n, window, params: 3 * n * math.log2(n),
+    multi_window_fn=pmutual_info_windows # NOTE: not strided, as pentropy
+)
+register_method(
+    pdtw,
+    cost=lambda n, window, params: (
+        n / params.get("stride", params.get("dtw_stride", 1)) * window * (2 * params["dtw_band"] + 1 if params.get("dtw_band") is not None else window)
+    ),
+    block_fn=pdtw_block, # NOTE: the k distances of a window start are one C call, parallel over the columns with OpenMP
+    batch_columns=True,
+    block_params=lambda params: {
+        "band": params.get("dtw_band"),
+        "stride": params.get("stride", params.get("dtw_stride", 1)),
+        "lower_bound": params.get("dtw_lower_bound", False),
+        "n_jobs": params.get("n_jobs", 1)
+    },
+    strided=True
+)
+register_method(pnoise, cost=lambda n, window, params: n, block_fn=pnoise_block, batch_columns=True, name_keyed=True, thread_safe=True)
+register_method(pnoiseskew10, cost=lambda n, window, params: n, block_fn=pnoiseskew10_block, batch_columns=True, name_keyed=True, thread_safe=True)
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+
+class SharedFrame:
+    '''
+    Read-only, memory-mapped view of the numeric columns of a DataFrame.
+    Pickling only carries the file path, column index and row index, so joblib workers
+    open the same pages instead of receiving a copy of the data with every task.
+    Supports the access pattern of the shaping functions: frame[column], frame[[columns]] and frame.index
+    '''
+    def __init__(self, path, columns, index, rows=slice(None)):
+        self.path = path
+        self.columns = list(columns)
+        self.index = index
+        self.rows = rows # NOTE: rows of the file this frame covers, see row_span
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+        self._values = None
+
+    @classmethod
+    def from_frame(cls, df, directory):
+        numeric = df.select_dtypes("number")
+        columns = [str(column) for column in numeric.columns]
+        path = os.path.join(directory, "frame.npy")
+        # NOTE: column-major so every column is one contiguous run of pages
+        values = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=numeric.shape, fortran_order=True)
+        values[:] = numeric.to_numpy(dtype=np.float64)
+        values.flush()
+        del values
+        return cls(path, columns, df.index)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.load(self.path, mmap_mode="r")[self.rows]
+        return self._values
+
+    def row_span(self, start, stop):
+        '''
+        SharedFrame of the rows [start, stop) on the same file, as df.iloc[start:stop], nothing is copied
+        '''
+        offset = self.rows.start or 0
+        return SharedFrame(self.path, self.columns, self.index[start:stop], rows=slice(offset + start, offset + stop))
+
+    def column_values(self, column):
+        return self.values[:, self._column_index[str(column)]]
+
+    def block(self, columns):
+        return self.values[:, [self._column_index[str(column)] for column in columns]]
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return pd.DataFrame(self.block(key), index=self.index, columns=[str(column) for column in key])
+        return pd.Series(self.column_values(key), index=self.index, name=str(key), copy=False)
+
+    def __contains__(self, column):
+        return str(column) in self._column_index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_values"] = None # NOTE: reopened lazily in the worker
+        return state
+
+
+@contextlib.contextmanager
+def shared_frame(df, directory=None):
+    '''
+    Writes the numeric columns of df once to a memory-mapped file and yields its SharedFrame handle.
+    The file is removed on exit.
+    '''
+    directory = tempfile.mkdtemp(prefix="shared_frame_", dir=directory)
+    try:
+        yield SharedFrame.from_frame(df, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
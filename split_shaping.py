@@ -0,0 +1,61 @@
+from datasets_metadata import ts_metadata
+from shared_frame import SharedFrame
+
+SPLITS = ("train", "valid", "test")
+
+
+def split_bounds(n, test_size, valid_size):
+    '''
+    {split: (start, stop)} row spans of n rows: the last test_size rows are the test split,
+    the valid_size rows before them the validation split and the rest the training split.
+    '''
+    if test_size + valid_size >= n:
+        raise ValueError(f"test_size {test_size} and valid_size {valid_size} leave no training rows out of {n}")
+    return {
+        "train": (0, n - valid_size - test_size),
+        "valid": (n - valid_size - test_size, n - test_size),
+        "test": (n - test_size, n),
+    }
+
+def dataset_split_bounds(dataset_name, n, metadata=ts_metadata):
+    return split_bounds(n, metadata[dataset_name]["test_size"], metadata[dataset_name]["valid_size"])
+
+def span_frame(df_raw, start, stop):
+    # NOTE: SharedFrame spans stay views on the same mapped file
+    if isinstance(df_raw, SharedFrame):
+        return df_raw.row_span(start, stop)
+    return df_raw.iloc[start:stop]
+
+def split_jobs(dataset_name, process_fn, params_list, bounds, splits=SPLITS):
+    '''
+    SPLIT-AWARE SHAPING
+    Turns the run_grid job of one (dataset, method), params_list holding every window, into one job per
+    (split, window) that shapes only the rows of the split. Each job's df_raw is the split span with the
+    window-1 rows before it in front as warm-up (as many as exist, none for train), so the first row of the
+    split has a full window and the p* functions normalize the saliency over the split rows only:
+    no statistics of a later split are used, and rows of the other splits are neither computed nor written.
+    The job carries "split", "span" (start, stop) and "warmup" rows, to drop with trim_warmup.
+    '''
+    jobs = []
+    for split in splits:
+        start, stop = bounds[split]
+        for window in params_list[0]["windows"]:
+            warmup = min(window - 1, start)
+            jobs += [{
+                "dataset_name": dataset_name,
+                "process_fn": process_fn,
+                "params_list": [dict(params, df_raw=span_frame(params["df_raw"], start - warmup, stop), windows=[window]) for params in params_list],
+                "split": split,
+                "span": (start, stop),
+                "warmup": warmup,
+            }]
+    return jobs
+
+def trim_warmup(results_processed, warmup):
+    '''
+    Drops the warm-up rows of split_jobs results, [({window: {"shaped", "inverted_shaped"}}, exogenous_feature)]
+    '''
+    return [
+        ({window: {key: qts_shaped.iloc[warmup:] for key, qts_shaped in agg_qts_shaped.items()} for window, agg_qts_shaped in windows_shaped.items()}, feature)
+        for windows_shaped, feature in results_processed
+    ]
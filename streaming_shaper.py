@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+from PyFARM import farm
+from preprocessing_utilities import multi_window_corr, multi_window_cov, rolling_relative_entropy, rolling_mutual_info, _dtw_windows
+
+NORMALIZATIONS = ("running", "fixed")
+
+
+def _pad(values, size):
+    # NOTE: sliding window results start at the first full window
+    return np.concatenate((np.full(size - values.size, np.nan), values))
+
+
+class StreamingShaper:
+    '''
+    Stateful shaping of one (target, exogenous) pair for one method and window, fed a few rows at a time.
+    Only the last window-1 rows are kept as rolling state, so update() costs O(window + new rows)
+    instead of a full-history recompute. The first update can carry the whole history.
+
+    Normalization of the saliency, which the batch functions do with the global min/max:
+    - "running": each update is normalized with the min/max of every saliency value seen so far,
+      including its own. Rows already returned are never revised, so earlier rows may have been
+      scaled with a narrower range than later ones.
+    - "fixed": min/max are frozen after the first update with a defined saliency (the history, once it
+      holds a full window) and later ratios are clipped to [0, 1], so every row is scaled the same way.
+    Either way, rescaled() re-applies the min/max of the whole stored saliency history to it (rescale on read),
+    which matches the batch functions without recomputing any saliency (pentropy aside, see below). That range
+    is tracked apart from the frozen "fixed" one, so under "fixed" rescaled() differs from the rows update()
+    returned once later saliencies leave the frozen range.
+    pfarm ratios are used as they are, like in pfarm.
+
+    pdtw evaluates every window, within the Sakoe-Chiba band of dtw_band steps as in pdtw, so it matches
+    pdtw with no stride.
+
+    pentropy/pmutual_info coalesce states over the rows seen so far. A value never seen before
+    relabels the states, which changes relative entropy (not mutual information), so pentropy rows
+    already returned match a batch run over the data available at the time, not over the final data,
+    and so does their saliency in rescaled().
+    '''
+    def __init__(self, method, window, target_feature, exogenous_feature, normalization="running", dtw_band=None):
+        if method not in STREAMING_SALIENCY:
+            raise ValueError(f"No streaming saliency for {method}, available: {list(STREAMING_SALIENCY)}")
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f"Unknown normalization {normalization}, available: {NORMALIZATIONS}")
+        self.method = method
+        self.window = window
+        self.target_feature = str(target_feature)
+        self.exogenous_feature = str(exogenous_feature)
+        self.normalization = normalization
+        self.dtw_band = dtw_band
+
+        self.saliency_min = np.nan # NOTE: range update() normalizes with, frozen under "fixed"
+        self.saliency_max = np.nan
+        self._history_min = np.nan # NOTE: range of every saliency seen, for rescaled()
+        self._history_max = np.nan
+        self._target_tail = np.empty(0)
+        self._exogenous_tail = np.empty(0)
+        self._target_states = np.empty(0, dtype=np.int32) # NOTE: every integer state seen, as coalesce_series
+        self._exogenous_states = np.empty(0, dtype=np.int32)
+        self._saliency = []
+        self._exogenous = []
+        self._index = []
+
+    def update(self, new_rows):
+        '''
+        Appends new_rows (a DataFrame holding the target and exogenous columns) and returns
+        {"shaped", "inverted_shaped"} Series for those rows only
+        '''
+        target_values = new_rows[self.target_feature].to_numpy(dtype=np.float64)
+        exogenous_values = new_rows[self.exogenous_feature].to_numpy(dtype=np.float64)
+        n_new = target_values.size
+
+        target = np.concatenate((self._target_tail, target_values))
+        exogenous = np.concatenate((self._exogenous_tail, exogenous_values))
+        if target.size >= self.window:
+            saliency = STREAMING_SALIENCY[self.method](self, target, exogenous, n_new)[-n_new:]
+        else:
+            saliency = np.full(n_new, np.nan)
+        keep = self.window - 1
+        self._target_tail = target[max(target.size - keep, 0):]
+        self._exogenous_tail = exogenous[max(exogenous.size - keep, 0):]
+
+        self._saliency += [saliency]
+        self._exogenous += [exogenous_values]
+        self._index += [new_rows.index]
+        if not np.isnan(saliency).all():
+            self._history_min = np.fmin(self._history_min, np.nanmin(saliency))
+            self._history_max = np.fmax(self._history_max, np.nanmax(saliency))
+            # NOTE: "fixed" freezes the range of the first update with a defined saliency, not of the first update
+            if self.normalization == "running" or np.isnan(self.saliency_min):
+                self.saliency_min, self.saliency_max = self._history_min, self._history_max
+
+        return self._shape(saliency, exogenous_values, new_rows.index, (self.saliency_min, self.saliency_max))
+
+    def rescaled(self):
+        '''
+        {"shaped", "inverted_shaped"} for every row seen, normalized with the min/max of all of them, as the batch functions
+        '''
+        index = self._index[0].append(self._index[1:]) if self._index else pd.RangeIndex(0)
+        saliency = np.concatenate(self._saliency) if self._saliency else np.empty(0)
+        exogenous = np.concatenate(self._exogenous) if self._exogenous else np.empty(0)
+        return self._shape(saliency, exogenous, index, (self._history_min, self._history_max), clip=False)
+
+    def _shape(self, saliency, exogenous_values, index, saliency_range, clip=None):
+        if self.method == "pfarm":
+            shaping_ratio = saliency
+        else:
+            saliency_min, saliency_max = saliency_range
+            with np.errstate(divide="ignore", invalid="ignore"):
+                shaping_ratio = (saliency - saliency_min)/(saliency_max - saliency_min) # normalizing between 0 and 1
+            if clip if clip is not None else self.normalization == "fixed":
+                shaping_ratio = np.clip(shaping_ratio, 0, 1)
+        shaping_ratio_inverted = np.abs(shaping_ratio - 1) # NOTE: INVERTING
+
+        shaping_ratio = np.where(np.isnan(shaping_ratio), 1, shaping_ratio) # NOTE: keep as it is if we can't calculate a ratio (NaN case)
+        shaping_ratio_inverted = np.where(np.isnan(shaping_ratio_inverted), 1, shaping_ratio_inverted)
+
+        return {
+            "shaped": pd.Series(exogenous_values * shaping_ratio, index=index, name=self.exogenous_feature),
+            "inverted_shaped": pd.Series(exogenous_values * shaping_ratio_inverted, index=index, name=self.exogenous_feature)
+        }
+
+    def _states(self, target, exogenous, n_new):
+        # NOTE: same labels coalesce_series gives over all rows seen so far
+        target_ints = target.astype(np.int32)
+        exogenous_ints = exogenous.astype(np.int32)
+        self._target_states = np.union1d(self._target_states, target_ints[-n_new:])
+        self._exogenous_states = np.union1d(self._exogenous_states, exogenous_ints[-n_new:])
+        return np.searchsorted(self._target_states, target_ints), np.searchsorted(self._exogenous_states, exogenous_ints)
+
+
+def _corr_saliency(shaper, target, exogenous, n_new):
+    return multi_window_corr(target, exogenous, [shaper.window])[shaper.window]
+
+def _cov_saliency(shaper, target, exogenous, n_new):
+    return multi_window_cov(target, exogenous, [shaper.window])[shaper.window]
+
+def _entropy_saliency(shaper, target, exogenous, n_new):
+    target_states, exogenous_states = shaper._states(target, exogenous, n_new)
+    return _pad(rolling_relative_entropy(target_states, exogenous_states, shaper.window), target.size)
+
+def _mutual_info_saliency(shaper, target, exogenous, n_new):
+    target_states, exogenous_states = shaper._states(target, exogenous, n_new)
+    return _pad(rolling_mutual_info(target_states, exogenous_states, shaper.window), target.size)
+
+def _dtw_saliency(shaper, target, exogenous, n_new):
+    # NOTE: only the windows ending at the new rows, with the same distance (C call, band) as pdtw
+    starts = np.arange(target.size - shaper.window + 1)[-n_new:]
+    return _pad(_dtw_windows(target, exogenous, shaper.window, starts, shaper.dtw_band), target.size)
+
+def _farm_saliency(shaper, target, exogenous, n_new):
+    # NOTE: FARM only sees the last window-1 rows of history besides the new ones
+    return np.asarray(farm(refTS=target, qryTS=exogenous, ff_align=False, lcwin=shaper.window, fuzzyc=[1])["rel_local_fuzz"], dtype=np.float64)
+
+STREAMING_SALIENCY = {
+    "prollcorr": _corr_saliency,
+    "prollcov": _cov_saliency,
+    "pentropy": _entropy_saliency,
+    "pmutual_info": _mutual_info_saliency,
+    "pdtw": _dtw_saliency,
+    "pfarm": _farm_saliency,
+}
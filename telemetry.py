@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import resource
+import contextlib
+
+import pandas as pd
+
+TRACE_ENV = "SHAPING_TRACE" # NOTE: set by configure, inherited by the joblib workers started afterwards
+
+
+def configure(path):
+    '''
+    Starts a new JSON-lines trace at path, or disables tracing with path=None.
+    Must run before the worker pools are created so the workers trace to the same file.
+    '''
+    if not path:
+        os.environ.pop(TRACE_ENV, None)
+        return
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+    os.environ[TRACE_ENV] = path
+
+def trace_path():
+    return os.environ.get(TRACE_ENV)
+
+@contextlib.contextmanager
+def span(name, **tags):
+    '''
+    Times the enclosed block as one trace record:
+    {"name", "start", "seconds", "pid", "peak_rss_mb", **tags}, tags being e.g. dataset, method, window, feature.
+    peak_rss_mb is the peak resident memory of the process (driver or worker) so far.
+    Spans nest, an outer span includes the time of the inner ones. No-op when tracing is off.
+    '''
+    path = trace_path()
+    if not path:
+        yield
+        return
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {
+            "name": name,
+            "start": start,
+            "seconds": time.perf_counter() - counter,
+            "pid": os.getpid(),
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # NOTE: KiB on Linux
+            **{key: value if isinstance(value, (int, float)) else str(value) for key, value in tags.items()}
+        }
+        # NOTE: one short appended line per span, processes do not interleave within a line
+        with open(path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+def load_trace(path=None):
+    path = path or trace_path()
+    with open(path) as file:
+        return pd.DataFrame([json.loads(line) for line in file if line.strip()])
+
+def summary(path=None, by=("name", "method")):
+    '''
+    End-of-run table of the trace: count, total/mean/max seconds and peak RSS per (span name, method),
+    slowest first, followed by the peak RSS of every process that traced.
+    '''
+    trace = load_trace(path)
+    if trace.empty:
+        return "Empty trace"
+    by = [column for column in by if column in trace.columns]
+    trace[by] = trace[by].fillna("-")
+    table = trace.groupby(by).agg(
+        count=("seconds", "size"),
+        total_s=("seconds", "sum"),
+        mean_s=("seconds", "mean"),
+        max_s=("seconds", "max"),
+        peak_rss_mb=("peak_rss_mb", "max")
+    ).sort_values("total_s", ascending=False)
+    processes = trace.groupby("pid")["peak_rss_mb"].max().sort_values(ascending=False)
+    return (
+        f"{table.to_string(float_format=lambda value: f'{value:.3f}')}\n\n"
+        f"Peak RSS per process (MiB): {', '.join(f'{pid}: {rss:.0f}' for pid, rss in processes.items())}"
+    )
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from canvas import convert_parquet_to_csv
+
+
+def _frame(n):
+    rng = np.random.default_rng(2)
+    return pd.DataFrame({
+        "date": pd.date_range("2016-07-01", periods=n, freq="h").astype(str),
+        "timestamp": pd.date_range("2016-07-01", periods=n, freq="37min"),
+        "whole": np.round(rng.normal(size=n) * 10), # NOTE: whole-number floats, "7.0" in to_csv
+        "value": rng.normal(size=n),
+        "missing": np.where(np.arange(n) % 5 == 0, np.nan, 1.0),
+        "count": np.arange(n),
+        "flag": np.arange(n) % 2 == 0,
+        "label": [["plain", "with, comma", 'with "quote"', "with\nnewline"][i % 4] for i in range(n)],
+    }, index=pd.Index(np.arange(n) * 2, name="row"))
+
+@pytest.mark.parametrize("n, row_group_size", [(0, 4), (3, 4), (50, 7), (50, 1000)])
+def test_parquet_to_csv_matches_to_csv(tmp_path, n, row_group_size):
+    df = _frame(n)
+    df.to_parquet(tmp_path / "frame.parquet")
+    convert_parquet_to_csv(str(tmp_path), n_jobs=1, row_group_size=row_group_size)
+    expected = pd.read_parquet(tmp_path / "frame.parquet").to_csv(index=False)
+    assert (tmp_path / "frame.csv").read_bytes() == expected.encode()
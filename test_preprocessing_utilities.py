@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocessing_utilities import prollcorr, prollcov, prollcorr_windows, prollcov_windows, prollcorr_block, prollcov_block
+from preprocessing_utilities import pdtw, pdtw_block, pnoise, pnoise_block
+from preprocessing_utilities import PARTITIONED, save_df_to_file, save_shaped_partition, load_shaped_df
+
+
+WINDOWS = [20, 50]
+
+@pytest.fixture
+def df_raw():
+    # NOTE: "flat" holds a constant run longer than every window, so some windows have zero variance
+    rng = np.random.default_rng(0)
+    target = rng.normal(size=400).cumsum()
+    flat = rng.normal(size=400).cumsum()
+    flat[150:260] = 3.0
+    return pd.DataFrame({"target": target, "flat": flat, "other": rng.normal(size=400)})
+
+@pytest.mark.parametrize("process_fn, windows_fn, block_fn", [
+    (prollcorr, prollcorr_windows, prollcorr_block),
+    (prollcov, prollcov_windows, prollcov_block),
+])
+def test_constant_windows_agree_on_every_path(df_raw, process_fn, windows_fn, block_fn):
+    features = ["flat", "other"]
+    params = {"df_raw": df_raw, "target_feature": "target", "exogenous_feature": "flat"}
+    windows_shaped, _ = windows_fn(dict(params, windows=WINDOWS))
+    blocks = block_fn(df_raw["target"].values, df_raw[features].to_numpy(), WINDOWS)
+    for window in WINDOWS:
+        single, _ = process_fn(dict(params, window=window))
+        for i, key in enumerate(("shaped", "inverted_shaped")):
+            np.testing.assert_allclose(single[key].values, windows_shaped[window][key].values, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(single[key].values, blocks[window][i][:, 0], rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("window", WINDOWS)
+def test_constant_windows_are_left_unshaped_by_prollcorr(df_raw, window):
+    shaped, _ = prollcorr({"df_raw": df_raw, "window": window, "target_feature": "target", "exogenous_feature": "flat"})
+    constant = np.arange(150 + window - 1, 260)
+    # NOTE: undefined correlation, ratio 1, where pandas rolling corr gives ±inf and skews the column's range
+    np.testing.assert_array_equal(shaped["shaped"].values[constant], df_raw["flat"].values[constant])
+    assert np.isfinite(shaped["shaped"].values).all()
+    # NOTE: the normalization range comes from the defined windows, their lowest correlation is scaled to 0
+    assert np.nanmin(np.abs(shaped["shaped"].values[window - 1:] / df_raw["flat"].values[window - 1:])) == pytest.approx(0, abs=1e-12)
+
+@pytest.mark.parametrize("options, block_options", [
+    ({}, {}),
+    ({"dtw_band": 5, "dtw_stride": 4}, {"band": 5, "stride": 4}),
+    ({"dtw_band": 5, "stride": 3, "stride_interpolation": "step"}, {"band": 5, "stride": 3, "interpolation": "step"}),
+])
+def test_pdtw_block_matches_pdtw(df_raw, options, block_options):
+    features = ["flat", "other"]
+    blocks = pdtw_block(df_raw["target"].values, df_raw[features].to_numpy(), WINDOWS, **block_options)
+    for window in WINDOWS:
+        for column, feature in enumerate(features):
+            single, _ = pdtw({"df_raw": df_raw, "window": window, "target_feature": "target", "exogenous_feature": feature, **options})
+            for i, key in enumerate(("shaped", "inverted_shaped")):
+                np.testing.assert_allclose(single[key].values, blocks[window][i][:, column], rtol=1e-12, atol=1e-12)
+
+def test_load_shaped_df_asks_for_a_split(tmp_path, df_raw):
+    bounds = {"train": (0, 300), "test": (300, 400)}
+    for split, (start, stop) in bounds.items():
+        rows = df_raw.iloc[start:stop]
+        save_df_to_file(rows, str(tmp_path), "raw", format=PARTITIONED, partition={"dataset": "ds", "split": split})
+        shaped, _ = prollcorr({"df_raw": rows, "window": 20, "target_feature": "target", "exogenous_feature": "other"})
+        save_shaped_partition([({20: shaped}, "other")], str(tmp_path), "ds", 20, "prollcorr", split=split)
+    loaded = load_shaped_df(str(tmp_path), "ds", 20, "prollcorr", split="test")
+    np.testing.assert_array_equal(loaded["target"].values, df_raw["target"].values[300:])
+    np.testing.assert_array_equal(loaded["other"].values, shaped["shaped"].values)
+    # NOTE: each split is normalized on its own rows, their union is not a variant of the whole series
+    with pytest.raises(ValueError, match="split"):
+        load_shaped_df(str(tmp_path), "ds", 20, "prollcorr")
+
+def test_noise_is_keyed_by_dataset_and_feature_names(df_raw):
+    df = df_raw.assign(copy=df_raw["other"])
+    params = {"df_raw": df, "window": 20, "target_feature": "target", "dataset_name": "ds"}
+    blocks = pnoise_block(df["target"].values, df[["other", "copy"]].to_numpy(), [20], dataset="ds", features=["other", "copy"])
+    shaped = {feature: pnoise(dict(params, exogenous_feature=feature))[0]["shaped"].values for feature in ("other", "copy")}
+    np.testing.assert_array_equal(shaped["other"], blocks[20][0][:, 0])
+    np.testing.assert_array_equal(shaped["copy"], blocks[20][0][:, 1])
+    # NOTE: equal values, independent draws
+    assert not np.allclose(shaped["other"][19:], shaped["copy"][19:])
+    renamed, _ = pnoise(dict(params, exogenous_feature="other", dataset_name="other ds"))
+    assert not np.allclose(renamed["shaped"].values[19:], shaped["other"][19:])
+    # NOTE: the draw does not follow the values, scaling the column scales the shaped series
+    scaled, _ = pnoise(dict(params, df_raw=df.assign(other=2 * df["other"]), exogenous_feature="other"))
+    np.testing.assert_allclose(scaled["shaped"].values, 2 * shaped["other"])
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocessing_utilities import prollcorr, pmutual_info
+from streaming_shaper import StreamingShaper
+
+
+WINDOW = 30
+
+@pytest.fixture
+def df_raw():
+    rng = np.random.default_rng(1)
+    target = rng.normal(size=600).cumsum()
+    exogenous = target + rng.normal(scale=3, size=600)
+    return pd.DataFrame({"target": np.round(target), "exogenous": np.round(exogenous)})
+
+def _stream(df_raw, method, normalization, sizes=(100, 7, 1, 200, 292)):
+    shaper = StreamingShaper(method, WINDOW, "target", "exogenous", normalization=normalization)
+    updates = []
+    start = 0
+    for size in sizes:
+        updates += [shaper.update(df_raw.iloc[start:start + size])]
+        start += size
+    return shaper, updates
+
+@pytest.mark.parametrize("normalization", ["running", "fixed"])
+@pytest.mark.parametrize("method, process_fn", [("prollcorr", prollcorr), ("pmutual_info", pmutual_info)])
+def test_rescaled_matches_batch(df_raw, method, process_fn, normalization):
+    shaper, _ = _stream(df_raw, method, normalization)
+    batch, _ = process_fn({"df_raw": df_raw, "window": WINDOW, "target_feature": "target", "exogenous_feature": "exogenous"})
+    rescaled = shaper.rescaled()
+    for key in ("shaped", "inverted_shaped"):
+        np.testing.assert_allclose(rescaled[key].values, batch[key].values, rtol=1e-9, atol=1e-9)
+
+def test_fixed_freezes_the_first_defined_range(df_raw):
+    shaper, updates = _stream(df_raw, "prollcorr", "fixed")
+    # NOTE: the first update holds the first full windows, its range is kept for every later row
+    first = shaper._saliency[0]
+    assert (shaper.saliency_min, shaper.saliency_max) == (np.nanmin(first), np.nanmax(first))
+    saliency = np.concatenate(shaper._saliency[1:])
+    ratio = np.clip((saliency - shaper.saliency_min) / (shaper.saliency_max - shaper.saliency_min), 0, 1)
+    shaped = pd.concat([update["shaped"] for update in updates[1:]]).values
+    np.testing.assert_allclose(shaped, df_raw["exogenous"].values[100:] * ratio)
+    # NOTE: later saliencies leave the frozen range, rescaled() normalizes them with the whole history instead
+    assert np.nanmin(saliency) < shaper.saliency_min or np.nanmax(saliency) > shaper.saliency_max
+    assert not np.allclose(shaper.rescaled()["shaped"].values[100:], shaped)